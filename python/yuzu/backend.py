@@ -1,24 +1,39 @@
-from rdflib import BNode, Graph, ConjunctiveGraph, OWL
-from rdflib.util import from_n3
+from rdflib import BNode, Graph, ConjunctiveGraph, OWL, RDF
 from rdflib.term import Literal, URIRef
 from rdflib.store import Store
 from yuzu.ql.parse import YuzuQLSyntax
 from yuzu.ql.model import QueryBuilder, sql_results_to_sparql_json
 from yuzu.ql.model import sql_results_to_sparql_xml, FullURI, YuzuQLError
+import base64
+import json
+import numbers
+import re
+import shutil
 import sqlite3
 import sys
+import os
 import getopt
+import tempfile
 import gzip
 import multiprocessing
+import threading
+import time
 import traceback
+from collections import deque
+from contextlib import contextmanager
 if sys.version_info[0] < 3:
     from urlparse import urlparse
-    from urllib import unquote
+    from urllib import quote, unquote
 else:
-    from urllib.parse import urlparse, unquote
+    from urllib.parse import urlparse, quote, unquote
 
 import yuzu.displayer
+from yuzu.cache import LRUCache, from_n3
 from yuzu.settings import (BASE_NAME, CONTEXT, DUMP_FILE, DB_FILE,
+                           SQLITE_MMAP_SIZE, SQLITE_IMMUTABLE,
+                           SQLITE_CACHE_SIZE,
+                           SQLITE_LOAD_CACHE_SIZE, LOAD_CACHE_MEMORY,
+                           PAGE_TABLE,
                            SPARQL_ENDPOINT, LABELS, FACETS, NOT_LINKED,
                            LINKED_SETS, MIN_LINKS, YUZUQL_LIMIT,
                            PREFIX1_URI, PREFIX1_QN,
@@ -70,47 +85,360 @@ class SPARQLExecutor(multiprocessing.Process):
             self.pipe.send(('error', YZ_BAD_MIME))
 
 
-def mainN3(n3):
-    if n3.startswith("<") and "#" in n3:
-        return n3[:n3.index("#")] + ">"
-    else:
-        return n3
+def split_n3(n3):
+    """Split a term into the namespace prefix and local name that it is
+    stored as (see create_tables). URIs are split after their last / or #,
+    other terms have an empty prefix
+    @param n3 The term as N3
+    @return The prefix and the local name
+    """
+    if n3.startswith("<"):
+        i = max(n3.rfind("/"), n3.rfind("#")) + 1
+        if i:
+            return n3[:i], n3[i:]
+    return "", n3
+
+
+# The SQL for the id of a term, with the prefix and local name (from
+# split_n3) as its two parameters. Databases with the layout version 1 or
+# earlier store the full N3 of each term
+TERM_ID_SQL = """(select id from terms where prefix=
+    (select id from prefixes where prefix=?) and local=?)"""
+OLD_TERM_ID_SQL = "(select id from ids where n3=?||?)"
 
 
 class LoadCache:
-    def __init__(self, cursor):
-        self.values = {}
-        self.added = []
+    """Maps N3 terms to their ids in the database while loading. The most
+    recently used terms are kept in memory and new terms are given ids in
+    memory and inserted in bulk. All of the prefixes (see split_n3) are kept
+    in memory"""
+    # The approximate memory used by each entry in addition to the term
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, cursor, memory=LOAD_CACHE_MEMORY):
+        """Create a cache
+        @param cursor The database cursor
+        @param memory The approximate number of bytes to use or None to keep
+        all terms in memory
+        """
+        self.terms = LRUCache(
+            memory,
+            sizeof=lambda key, value: len(key) + LoadCache.ENTRY_OVERHEAD)
         self.cursor = cursor
+        cursor.execute("select max(id) from terms")
+        max_id, = cursor.fetchone()
+        self.next_id = (max_id or 0) + 1
+        cursor.execute("select prefix, id from prefixes")
+        self.prefixes = dict(cursor.fetchall())
+        # If the database starts empty and nothing is evicted, any term not
+        # in memory is not in the database either
+        self.complete = memory is None and self.next_id == 1
 
-    def get(self, key):
-        if key in self.values:
-            return self.values[key]
-        else:
-            self.cursor.execute("select id from ids where n3=?", (key,))
-            row = self.cursor.fetchone()
-            if not row:
-                self.cursor.execute(
-                    "insert into ids (n3, main) values (?, ?)",
-                    (key, mainN3(key)))
+    def get_many(self, keys):
+        """Resolve many terms at once, adding any new terms to the database
+        @param keys The N3 terms (in order of first occurrence)
+        @return A dictionary mapping each term to its id
+        """
+        ids = {}
+        missing = []
+        for key in keys:
+            value = self.terms.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                ids[key] = value
+        if not self.complete:
+            ids.update(self.find(missing))
+        new = []
+        for key in missing:
+            if key not in ids:
+                ids[key] = self.next_id
+                prefix, local = split_n3(key)
+                new.append((self.next_id, self.prefix_id(prefix), local))
+                self.next_id += 1
+            self.terms.put(key, ids[key])
+        self.cursor.executemany(
+            "insert into terms (id, prefix, local) values (?, ?, ?)", new)
+        return ids
+
+    def find(self, keys):
+        """Find the ids of terms in the database, without adding them
+        @param keys The N3 terms
+        @return A dictionary mapping each term in the database to its id
+        """
+        by_prefix = {}
+        for key in keys:
+            prefix, local = split_n3(key)
+            if prefix in self.prefixes:
+                by_prefix.setdefault(prefix, []).append(local)
+        ids = {}
+        for prefix, names in by_prefix.items():
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
                 self.cursor.execute(
-                    "select id from ids where n3=?", (key,))
-                row = self.cursor.fetchone()
+                    """select local, id from terms
+                       where prefix=? and local in (%s)""" %
+                    ",".join("?" * len(chunk)),
+                    [self.prefixes[prefix]] + chunk)
+                ids.update((prefix + local, id)
+                           for local, id in self.cursor.fetchall())
+        return ids
+
+    def prefix_id(self, prefix):
+        """Get the id of a prefix, adding it to the database if it is new"""
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = len(self.prefixes) + 1
+            self.cursor.execute("insert into prefixes values (?, ?)",
+                                (self.prefixes[prefix], prefix))
+        return self.prefixes[prefix]
+
+
+def parse_ntriple(line):
+    """Split a line of an N-Triples file into its normalised terms
+    @param line The line (as bytes)
+    @return A tuple of subject, property and object as N3 or None if the line
+    does not contain a triple
+    """
+    text = unicode_escape(line.decode('utf-8'))
+    if not text.strip() or text.startswith("#"):
+        return None
+    e = text.split(" ")
+    return (RDFBackend.fix_uri(e[0]), RDFBackend.fix_uri(e[1]),
+            RDFBackend.fix_uri(" ".join(e[2:-1])))
+
+
+def batches(input_stream, size):
+    """Split an input stream into lists of lines
+    @param input_stream The input
+    @param size The number of lines in each list
+    """
+    batch = []
+    for line in input_stream:
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_batch(lines):
+    """Parse a list of lines of an N-Triples file
+    @param lines The lines (as bytes)
+    @return The number of lines and the list of triples they contain
+    """
+    return len(lines), [t for t in (parse_ntriple(line) for line in lines)
+                        if t]
+
+
+def parse_batches(input_stream, batch_size, processes=1):
+    """Parse an N-Triples file in batches, optionally in several processes.
+    The batches are returned in the order of the input
+    @param input_stream The input of NTriples
+    @param batch_size The number of lines in each batch
+    @param processes The number of processes to parse with
+    @return A generator of the results of parse_batch
+    """
+    if processes <= 1:
+        for batch in batches(input_stream, batch_size):
+            yield parse_batch(batch)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = deque()
+            for batch in batches(input_stream, batch_size):
+                pending.append(pool.apply_async(parse_batch, (batch,)))
+                # Read ahead only a few batches to bound memory use
+                if len(pending) > 2 * processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class LoadTimer:
+    """Records the time spent in each phase of a load"""
+    def __init__(self):
+        self.phases = []
+        self.times = {}
+        self.start = time.time()
+
+    def elapsed(self):
+        """The time since the timer was created"""
+        return time.time() - self.start
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of code, adding to any earlier time of the phase
+        @param name The name of the phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            if name not in self.times:
+                self.phases.append(name)
+                self.times[name] = 0.0
+            self.times[name] += time.time() - start
+
+    @staticmethod
+    def phase_of(timer, name):
+        """Time a phase if there is a timer"""
+        if timer:
+            return timer.phase(name)
+        else:
+            return _no_timer()
+
+    def report(self, out=sys.stderr):
+        """Write the time of each phase"""
+        total = self.elapsed()
+        other = total - sum(self.times.values())
+        for name, t in ([(name, self.times[name]) for name in self.phases] +
+                        [("other", other)]):
+            out.write("%-24s %8.2fs %5.1f%%\n" % (
+                name, t, 100.0 * t / total if total else 0.0))
+        out.write("%-24s %8.2fs\n" % ("total", total))
+
 
-            if len(self.added) >= 1000:
-                to_remove = self.added[0]
-                self.added = self.added[1:]
-                del self.values[to_remove]
+@contextmanager
+def _no_timer():
+    yield
 
-            value, = row
-            self.added.append(key)
-            self.values[key] = value
-            return value
+
+# The version of the database layout written by load, stored as the
+# user_version of the database. Databases written by older versions are still
+# served:
+#  1: Blank node triples are stored under each page they can be reached from
+#  2: The terms are stored by prefix and local name (the ids table is a view)
+SCHEMA_VERSION = 2
+
+
+class ConnectionPool:
+    """Hands out one read-only connection per thread, so that connections
+    are opened once and reused across requests"""
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.inode = None
+        self.reset()
+
+    def reset(self):
+        """Forget all connections, e.g., after the process has forked"""
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.connections = []
+
+    def get(self):
+        """Get the connection for the current thread
+        @return A SQLite connection
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.inode != self.inode:
+            # The database file was replaced since this connection was opened
+            with self.lock:
+                self.connections.remove(conn)
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+            self.local.inode = self.inode
+            self.local.version, = conn.execute(
+                "PRAGMA user_version").fetchone()
+            self.local.tables = set(name for name, in conn.execute(
+                "select name from sqlite_master where type='table'"))
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def connect(self):
+        """Open a read-only connection to the database. If SQLITE_IMMUTABLE
+        is set (and URIs are supported) the database is opened as immutable,
+        so that SQLite reads it without taking any locks
+        @return A SQLite connection
+        """
+        if SQLITE_IMMUTABLE and sys.version_info[0] >= 3:
+            uri = "file:%s?mode=ro&immutable=1" % quote(
+                os.path.abspath(self.db))
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db, check_same_thread=False)
+        conn.execute("PRAGMA query_only=1")
+        if SQLITE_MMAP_SIZE is None:
+            conn.execute("PRAGMA mmap_size=%d" % os.path.getsize(self.db))
+        else:
+            conn.execute("PRAGMA mmap_size=%d" % SQLITE_MMAP_SIZE)
+        conn.execute("PRAGMA cache_size=%d" % SQLITE_CACHE_SIZE)
+        # Sorts and temporary indexes are small, keep them off the disk
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def version(self):
+        """Get the layout version of the database (see SCHEMA_VERSION)"""
+        self.get()
+        return self.local.version
+
+    def has_table(self, name):
+        """Check if the database has a (possibly optional) table"""
+        self.get()
+        return name in self.local.tables
+
+    def close(self):
+        """Close all connections held by the pool"""
+        with self.lock:
+            connections = self.connections
+            self.reset()
+        for conn in connections:
+            conn.close()
 
 
 class RDFBackend(Store):
     def __init__(self, db=DB_FILE):
         self.db = db
+        self.pool = ConnectionPool(db)
+
+    def connection(self):
+        """Get a read-only connection to the database for this thread"""
+        return self.pool.get()
+
+    def close(self):
+        """Close all connections to the database"""
+        self.pool.close()
+
+    def term_sql(self):
+        """Get the SQL for the id of a term in this database, which takes
+        the parameters given by split_n3 (see TERM_ID_SQL)"""
+        if self.pool.version() >= 2:
+            return TERM_ID_SQL
+        else:
+            return OLD_TERM_ID_SQL
+
+    def quoted_term_sql(self, n3):
+        """Get the SQL for the id of a term, with the term quoted in it (see
+        term_sql)
+        @param n3 The term as N3
+        """
+        parts = self.term_sql().split("?")
+        args = ["'%s'" % arg.replace("'", "''") for arg in split_n3(n3)]
+        return "".join(part + arg for part, arg in zip(parts, args + [""]))
+
+    def generation(self):
+        """Get a stamp that changes whenever the database file is replaced
+        or written to
+        @return The stamp as a string or None if there is no database
+        """
+        try:
+            st = os.stat(self.db)
+        except OSError:
+            return None
+        self.pool.inode = st.st_ino
+        return "%x-%x-%x" % (st.st_ino, int(st.st_mtime * 1000000),
+                             st.st_size)
 
     @staticmethod
     def name(id, frag):
@@ -147,86 +475,147 @@ class RDFBackend(Store):
         @param id The id
         @return A RDFlib Graph or None if the ID is not found
         """
-        g = ConjunctiveGraph()
-        g.bind("lemon", "http://lemon-model.net/lemon#")
-        g.bind("owl", str(OWL))
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            """select subject, property, object from triples where
-            page=?""", (unicode_escape(id),))
-        rows = cursor.fetchall()
+        rows = self.lookup_rows(id)
         if rows:
+            g = ConjunctiveGraph()
+            g.bind("lemon", "http://lemon-model.net/lemon#")
+            g.bind("owl", str(OWL))
             for s, p, o in rows:
                 g.add((from_n3(s), from_n3(p), from_n3(o)))
-                if o.startswith("_:"):
-                    self.lookup_blanks(g, o, conn)
-            conn.close()
             return g
         else:
             return None
 
-    def lookup_blanks(self, g, bn, conn):
-        """Recursively find any relevant blank nodes for
-        the current lookup
-        @param g The graph
-        @param bn The blank node ID (starting _:)
-        @param conn The database connection
+    def lookup_rows(self, id):
+        """Find the triples of a single page
+        @param id The id
+        @return The list of triples (as N3) of the page and its blank nodes
         """
-        cursor = conn.cursor()
-        cursor.execute("""select subject, property, object from triples where
-        page="<BLANK>" """, (bn[2:],))
-        rows = cursor.fetchall()
-        if rows:
-            for s, p, o in rows:
-                g.add((from_n3(s), from_n3(p), from_n3(o)))
-            if o.startswith("_:"):
-                self.lookup_blanks(g, o, conn)
-        cursor.close()
+        cursor = self.connection().cursor()
+        page = unicode_escape(id)
 
-    def get_label(self, uri, conn):
-        cursor = conn.cursor()
-        cursor.execute("""select label from ids where n3=?""",
-                       ("<%s>" % uri,))
-        row = cursor.fetchone()
-        if row:
-            label, = row
-            return label
+        if self.pool.has_table("page_triples"):
+            cursor.execute("""select subject, property, object
+            from page_triples where page=?""", (page,))
+        elif self.pool.version() >= 1:
+            cursor.execute("""select subject, property, object from triples
+            where page=?""", (page,))
         else:
-            return yuzu.displayer.DISPLAYER.uri_to_str(uri)
+            # The page and (in the same query) all the blank nodes that can be
+            # reached from it. The union (not union all) stops on cycles and
+            # +page keeps SQLite from scanning every blank node by the pages
+            # index
+            cursor.execute(
+                """with recursive blanks(id) as (
+                    select oid from tripids join ids on tripids.oid=ids.id
+                    where page=? and substr(ids.n3, 1, 2)='_:'
+                    union
+                    select oid from blanks
+                    join tripids on tripids.sid=blanks.id
+                    join ids on tripids.oid=ids.id
+                    where +page='<BLANK>' and substr(ids.n3, 1, 2)='_:')
+                select subject, property, object from triples where page=?
+                union all
+                select subject, property, object from triples
+                where sid in blanks and +page='<BLANK>'""", (page, page))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
 
-    def search(self, query, prop, offset, limit=20):
+    def search(self, query, prop, offset, limit=20, after=None):
         """Search for pages with the appropriate property
         @param query The value to query for
         @param prop The property to use or None for no properties
+        @param offset The number of results to skip (ignored if after is
+        given)
         @param limit The result limit
+        @param after A token (from a previous result) to continue the search
+        after
         @return The list of matching IDs
         """
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
+        cursor = self.connection().cursor()
 
-        if prop:
-            cursor.execute("""select distinct subj.main from free_text
-            join ids as subj on free_text.sid=subj.id
-            join ids as prop on free_text.pid=prop.id
-            where prop.n3=? and object match ?
-            order by length(object) asc
-            limit ? offset ?""",
-                           ("<%s>" % prop, query, limit + 1, offset))
+        if self.pool.has_table("free_text_ids"):
+            # The rows are numbered from the shortest text, so the matches
+            # are read in order and the query stops once the page is full
+            match = fts_query(query)
+            if not match:
+                cursor.close()
+                return []
+            last = decode_token(after, [int])[0] if after else 0
+            if prop:
+                prop_filter = "and free_text_ids.pid=" + self.term_sql()
+                prop_args = split_n3("<%s>" % prop)
+            else:
+                prop_filter = ""
+                prop_args = ()
+            cursor.execute("""select free_text_ids.page, free_text.rowid
+            from free_text join free_text_ids
+            on free_text_ids.rowid=free_text.rowid
+            where free_text match ? and free_text.rowid>? %s
+            order by free_text.rowid""" % prop_filter,
+                           (match, last) + prop_args)
+            pages = []
+            tokens = {}
+            seen = set()
+            check = self.connection().cursor()
+            for page, rowid in cursor:
+                if page in seen:
+                    continue
+                seen.add(page)
+                if after:
+                    # Skip the pages that were listed before the token
+                    check.execute("""select 1 from free_text_ids
+                    cross join free_text
+                    on free_text.rowid=free_text_ids.rowid
+                    where free_text_ids.page=? and free_text_ids.rowid<=?
+                    and free_text match ? %s limit 1""" % prop_filter,
+                                  (page, last, match) + prop_args)
+                    if check.fetchone():
+                        continue
+                elif len(seen) <= offset:
+                    continue
+                page = "<%s%s>" % (BASE_NAME, page)
+                pages.append(page)
+                tokens[page] = encode_token([rowid])
+                if len(pages) > limit:
+                    break
+            check.close()
         else:
-            cursor.execute("""select distinct subj.main from free_text
-            join ids as subj on free_text.sid=subj.id
-            where object match ?
-            order by length(object) asc
-            limit ? offset ?""",
-                           (query, limit + 1, offset))
-        rows = cursor.fetchall()
+            # A database with an FTS4 index (see upgrade)
+            if prop:
+                cursor.execute("""select distinct subj.main from free_text
+                join ids as subj on free_text.sid=subj.id
+                join ids as prop on free_text.pid=prop.id
+                where prop.n3=? and object match ?
+                order by length(object) asc
+                limit ? offset ?""",
+                               ("<%s>" % prop, query, limit + 1, offset))
+            else:
+                cursor.execute("""select distinct subj.main from free_text
+                join ids as subj on free_text.sid=subj.id
+                where object match ?
+                order by length(object) asc
+                limit ? offset ?""",
+                               (query, limit + 1, offset))
+            pages = [page for page, in cursor.fetchall()]
+            tokens = {}
+        # Find the labels of all the results at once (joining them in the
+        # first query would look up a label for every match before the
+        # limit is applied)
+        labels = {}
+        if pages:
+            cursor.execute("select n3, label from ids where id in (%s)" %
+                           ", ".join([self.term_sql()] * len(pages)),
+                           [arg for page in pages for arg in split_n3(page)])
+            labels = dict(cursor.fetchall())
         results = [{'link': page[1:-1],
-                    'label': self.get_label(page[1:-1], conn),
-                    'id': page[1 + len(BASE_NAME):-1]}
-                   for page, in rows]
-        conn.close()
+                    'label': (labels.get(page) or
+                              yuzu.displayer.DISPLAYER.uri_to_str(page[1:-1])),
+                    'id': page[1 + len(BASE_NAME):-1],
+                    'token': tokens.get(page)}
+                   for page in pages]
+        cursor.close()
         return results
 
     def summarize(self, id):
@@ -234,86 +623,160 @@ class RDFBackend(Store):
         @param id The id
         @return A RDFlib Graph or None if the ID is not found
         """
-        g = ConjunctiveGraph()
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
+        return self.summarize_many([id])[id]
 
-        cursor.execute(
-            """select subject, property, object from triples where
-            subject=?""", ("<%s%s>" % (BASE_NAME, unicode_escape(id)),))
-        rows = cursor.fetchall()
-        added = 0
-        if rows:
-            for s, p, o in rows:
-                for f in FACETS:
-                    if added < 20 and str(p)[1:-1] == f["uri"]:
-                        g.add((from_n3(s), from_n3(p), from_n3(o)))
-                        added += 1
-            conn.close()
-        return g
+    def summarize_many(self, ids, limit=20):
+        """Summarize several ids at once, by their values for the FACETS
+        @param ids The ids
+        @param limit The maximum number of triples in each summary
+        @return A dictionary from each id to its summary (an RDFlib Graph,
+        as used by from_model)
+        """
+        graphs = dict((id, ConjunctiveGraph()) for id in ids)
+        if not ids or not FACETS:
+            return graphs
+        subjects = dict(("<%s%s>" % (BASE_NAME, unicode_escape(id)), id)
+                        for id in ids)
+        cursor = self.connection().cursor()
+        cursor.execute("""select subj.n3, prop.n3, obj.n3 from (
+            select sid, pid, oid, row_number() over
+                (partition by sid order by tripids.rowid) as n
+            from tripids
+            where sid in (%s) and pid in (%s)) as summary
+            join ids as subj on summary.sid=subj.id
+            join ids as prop on summary.pid=prop.id
+            join ids as obj on summary.oid=obj.id
+            where n<=?""" % (", ".join([self.term_sql()] * len(subjects)),
+                             ", ".join([self.term_sql()] * len(FACETS))),
+                       [arg for n3 in list(subjects) +
+                        ["<%s>" % f["uri"] for f in FACETS]
+                        for arg in split_n3(n3)] + [limit])
+        for s, p, o in cursor.fetchall():
+            graphs[subjects[s]].add((from_n3(s), from_n3(p), from_n3(o)))
+        cursor.close()
+        return graphs
 
-    def list_resources(self, offset, limit, prop=None, obj=None):
+    def list_resources(self, offset, limit, prop=None, obj=None,
+                       after=None):
         """
         Produce the list of all pages in the resource
-        @param offset Where to start
+        @param offset Where to start (ignored if after is given)
         @param limit How many results
+        @param after A token (from a previous result) to continue the list
+        after. Unlike the offset, this does not make later pages slower
         @return A tuple consisting of a boolean indicating if there are more
         results and the list of IDs that can be found
         """
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
+        cursor = self.connection().cursor()
+        if after:
+            page = decode_token(after, [str])[0]
+            offset = 0
+        else:
+            page = ""
         if prop:
             if obj:
                 cursor.execute("""select distinct page, subj_label
-                from triples where property=? and object=? and head=0
-                limit ? offset ?""",
-                               (prop, obj, limit + 1, offset))
+                from triples where pid=%s and oid=%s and head=0 and page>?
+                order by page limit ? offset ?""" % (self.term_sql(),
+                                                     self.term_sql()),
+                               split_n3(prop) + split_n3(obj) +
+                               (page, limit + 1, offset))
             else:
                 cursor.execute("""select distinct page, subj_label from
-                triples where property=? and head=0 limit ? offset ?""",
-                               (prop, limit + 1, offset))
+                triples where pid=%s and head=0
+                and page>? order by page limit ? offset ?""" %
+                               self.term_sql(),
+                               split_n3(prop) + (page, limit + 1, offset))
         else:
             cursor.execute("""select distinct page, subj_label from
-            triples where head=0 limit ? offset ?""", (limit + 1, offset))
+            triples where head=0 and page>? order by page limit ? offset ?""",
+                           (page, limit + 1, offset))
         row = cursor.fetchone()
         n = 0
         refs = []
         while n < limit and row:
             uri, label = row
             if uri != "<BLANK>":
-                if label:
-                    refs.append({'link': CONTEXT + "/" + uri, 'label': label,
-                                 'id': uri})
-                else:
-                    refs.append({'link': CONTEXT + "/" + uri, 'label': uri,
-                                 'id': uri})
+                refs.append({'link': CONTEXT + "/" + uri,
+                             'label': label or uri,
+                             'id': uri,
+                             'token': encode_token([uri])})
             n += 1
             row = cursor.fetchone()
-        conn.close()
+        cursor.close()
         return n == limit, refs
 
-    def list_values(self, offset, limit, prop):
+    def list_values(self, offset, limit, prop, after=None):
         """
         Produce a list of all possible values for a particular property
-        @param offset Where to start listing
+        @param offset Where to start listing (ignored if after is given)
         @param limit Number of values to list
         @param prop The property to list for
+        @param after A token (from a previous result) to continue the list
+        after
         @return A tuple consisting of a boolean indicating if there are more
         results and list of values that exist (as N3)
         """
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
+        cursor = self.connection().cursor()
         if not offset:
             offset = 0
-        cursor.execute("""SELECT DISTINCT object, obj_label, count(*)
-                          FROM triples WHERE property=? AND head=0
-                          GROUP BY oid ORDER BY count(*) DESC
-                          LIMIT ? OFFSET ?""", (prop, limit + 1, offset))
+        if after:
+            last_count, last_oid = decode_token(after, [int, int])
+            offset = 0
+        counted = False
+        if self.pool.has_table("facet_counts"):
+            cursor.execute("""select 1 from facet_counts
+                              where pid=%s limit 1""" % self.term_sql(),
+                           split_n3(prop))
+            counted = cursor.fetchone() is not None
+        if counted:
+            # The counts of the facets were computed by the loader
+            if after:
+                # The rest of the values with the same count and then the
+                # values with lower counts, as two range scans (an OR of the
+                # two conditions would scan all of the values with the count)
+                cursor.execute("""SELECT n3, label, count, oid FROM (
+                    SELECT * FROM (SELECT pid, oid, count FROM facet_counts
+                        WHERE pid=%s AND
+                        count=? AND oid>? ORDER BY oid LIMIT ?)
+                    UNION ALL
+                    SELECT * FROM (SELECT pid, oid, count FROM facet_counts
+                        WHERE pid=%s AND
+                        count<? ORDER BY count DESC, oid LIMIT ?)
+                    LIMIT ?) AS facet JOIN ids ON facet.oid=ids.id
+                    ORDER BY count DESC, oid""" % (self.term_sql(),
+                                                   self.term_sql()),
+                               split_n3(prop) +
+                               (last_count, last_oid, limit + 1) +
+                               split_n3(prop) +
+                               (last_count, limit + 1, limit + 1))
+            else:
+                cursor.execute("""SELECT n3, label, count, oid
+                    FROM facet_counts JOIN ids ON facet_counts.oid=ids.id
+                    WHERE pid=%s
+                    ORDER BY count DESC, oid LIMIT ? OFFSET ?""" %
+                               self.term_sql(),
+                               split_n3(prop) + (limit + 1, offset))
+        elif after:
+            cursor.execute("""SELECT DISTINCT object, obj_label, count(*), oid
+                              FROM triples WHERE pid=%s AND head=0
+                              GROUP BY oid HAVING count(*) < ? OR
+                              (count(*) = ? AND oid > ?)
+                              ORDER BY count(*) DESC, oid LIMIT ?""" %
+                           self.term_sql(),
+                           split_n3(prop) + (last_count, last_count, last_oid,
+                                             limit + 1))
+        else:
+            cursor.execute("""SELECT DISTINCT object, obj_label, count(*), oid
+                              FROM triples WHERE pid=%s AND head=0
+                              GROUP BY oid ORDER BY count(*) DESC, oid
+                              LIMIT ? OFFSET ?""" % self.term_sql(),
+                           split_n3(prop) + (limit + 1, offset))
         row = cursor.fetchone()
         n = 0
         results = []
         while n < limit and row:
-            obj, label, count = row
+            obj, label, count, oid = row
             n3 = from_n3(obj)
             if type(n3) == Literal:
                 results.append({'link': obj, 'label': n3.value,
@@ -333,9 +796,11 @@ class RDFBackend(Store):
                                     'label': yuzu.displayer.DISPLAYER.apply(
                                         str(n3)),
                                     'count': count})
+            if results:
+                results[-1]['token'] = encode_token([count, oid])
             n += 1
             row = cursor.fetchone()
-        conn.close()
+        cursor.close()
         return n == limit, results
 
     def sparql_query(self, q, mime_type, default_graph_uri, timeout):
@@ -345,6 +810,9 @@ class RDFBackend(Store):
         @param default_graph_uri The default graph URI
         @param start_response The response object
         @param timeout The timeout (in seconds) on the query
+        @return A tuple consisting of a boolean indicating if the query timed
+        out, the type of the result and the result (as a string or as a
+        generator of strings)
         """
         try:
             syntax = YuzuQLSyntax()
@@ -371,17 +839,15 @@ class RDFBackend(Store):
             if select.limit < 0 or (select.limit >= YUZUQL_LIMIT and
                                     YUZUQL_LIMIT >= 0):
                 return False, 'error', YZ_QUERY_LIMIT_EXCEEDED % YUZUQL_LIMIT
-            qb = QueryBuilder(select)
+            qb = QueryBuilder(select, self.quoted_term_sql, False)
             sql_query = qb.build()
-            conn = sqlite3.connect(self.db)
-            cursor = conn.cursor()
+            cursor = self.connection().cursor()
             cursor.execute(sql_query)
             vars = qb.vars()
             if mime_type == "sparql-json":
-                results = sql_results_to_sparql_json(cursor.fetchall(), vars)
+                results = sql_results_to_sparql_json(fetch_rows(cursor), vars)
             else:
-                results = sql_results_to_sparql_xml(cursor.fetchall(), vars)
-            conn.close()
+                results = sql_results_to_sparql_xml(fetch_rows(cursor), vars)
             return False, 'sparql', results
         except Exception as e:
             if SPARQL_ENDPOINT:
@@ -415,6 +881,28 @@ class RDFBackend(Store):
                 print(e)
                 return False, 'error', ""
 
+    @staticmethod
+    def link_target(obj):
+        """Find the dataset that the object of a triple links to
+        @param obj The object (as N3)
+        @return The URI of the linked dataset or None if the object is not a
+        link to another dataset
+        """
+        if not obj.startswith("<"):
+            return None
+        obj_uri = obj[1:-1]
+        if obj_uri.startswith(BASE_NAME) or not obj_uri.startswith("http"):
+            return None
+        for link in NOT_LINKED:
+            if obj_uri.startswith(link):
+                return None
+        up = urlparse(obj_uri)
+        target = "%s://%s/" % (up.scheme, up.netloc)
+        for ls in LINKED_SETS:
+            if obj_uri.startswith(ls):
+                target = ls
+        return target
+
     @staticmethod
     def split_uri(subj):
         if '#' in subj:
@@ -430,26 +918,48 @@ class RDFBackend(Store):
         return id, frag
 
     @staticmethod
-    def create_tables(cursor):
-        cursor.execute("""CREATE TABLE IF NOT EXISTS ids
+    def create_tables(cursor, indexes=True):
+        """Create the tables of the database
+        @param cursor The database cursor
+        @param indexes If false do not create the indexes (call create_indexes
+        after inserting the data instead)
+        """
+        # Each term is stored as its prefix (shared by many terms) and local
+        # name. The ids view gives the full N3 of each term and the N3 of
+        # the page it belongs to (main). Every term has a prefix, but the left
+        # join lets SQLite skip the prefix when only the label is read
+        cursor.execute("""CREATE TABLE IF NOT EXISTS prefixes
                           (id integer primary key,
-                           n3 text not null,
-                           main text not null,
-                           label text, unique(n3))""")
-        cursor.execute("""CREATE INDEX n3s on ids (n3)""")
+                           prefix text not null, unique(prefix))""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS terms
+                          (id integer primary key,
+                           prefix integer not null,
+                           local text not null,
+                           label text, unique(prefix, local),
+                           foreign key (prefix) references prefixes)""")
+        cursor.execute("""CREATE VIEW IF NOT EXISTS ids AS
+                          SELECT terms.id AS id,
+                                 prefixes.prefix || local AS n3,
+                                 CASE WHEN prefixes.prefix LIKE '<%#%'
+                                 THEN substr(prefixes.prefix, 1,
+                                             instr(prefixes.prefix, '#') - 1)
+                                      || '>'
+                                 ELSE prefixes.prefix || local END AS main,
+                                 label
+                          FROM terms
+                          LEFT JOIN prefixes ON terms.prefix=prefixes.id""")
+        # head is 0 for the triples of the page itself, 2 for the extra copies
+        # of the triples of a blank node that is shown on several pages (see
+        # assign_blank_nodes) and 1 for all other triples
         cursor.execute("""CREATE TABLE IF NOT EXISTS tripids
                           (sid integer not null,
                            pid integer not null,
                            oid integer not null,
                            page text,
                            head boolean,
-                           foreign key (sid) references ids,
-                           foreign key (pid) references ids,
-                           foreign key (oid) references ids)""")
-        cursor.execute("""CREATE INDEX subjects ON tripids(sid)""")
-        cursor.execute("""CREATE INDEX properties ON tripids(pid)""")
-        cursor.execute("""CREATE INDEX objects ON tripids(oid)""")
-        cursor.execute("""CREATE INDEX pages ON tripids(page)""")
+                           foreign key (sid) references terms,
+                           foreign key (pid) references terms,
+                           foreign key (oid) references terms)""")
         cursor.execute("""CREATE VIEW triples AS SELECT page, sid, pid, oid,
                   subj.n3 AS subject, subj.label AS subj_label,
                   prop.n3 AS property, prop.label AS prop_label,
@@ -458,10 +968,187 @@ class RDFBackend(Store):
                   JOIN ids AS subj ON tripids.sid=subj.id
                   JOIN ids AS prop ON tripids.pid=prop.id
                   JOIN ids AS obj ON tripids.oid=obj.id""")
-        cursor.execute("""CREATE VIRTUAL TABLE free_text
-                          USING fts4(sid integer, pid integer,
-                                     object TEXT NOT NULL)""")
+        RDFBackend.create_free_text(cursor)
         cursor.execute("""CREATE TABLE links (count integer, target text)""")
+        if indexes:
+            RDFBackend.create_indexes(cursor)
+
+    @staticmethod
+    def create_free_text(cursor):
+        """Create the search index. The text is not copied into the index,
+        instead it is read from ids (through the free_text_rows view)
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE TABLE free_text_ids
+                          (sid integer not null,
+                           pid integer not null,
+                           oid integer not null,
+                           page text not null)""")
+        cursor.execute("""CREATE VIEW free_text_rows AS SELECT
+                  free_text_ids.rowid AS tid, sid, pid, ids.n3 AS object
+                  FROM free_text_ids
+                  JOIN ids ON free_text_ids.oid=ids.id""")
+        cursor.execute("""CREATE VIRTUAL TABLE free_text
+                          USING fts5(sid UNINDEXED, pid UNINDEXED, object,
+                                     content='free_text_rows',
+                                     content_rowid='tid',
+                                     prefix='2 3')""")
+
+    @staticmethod
+    def index_free_text(cursor):
+        """Build the search index from the text collected in the free_text_load
+        table. The rows are numbered from the shortest text to the longest,
+        so that search can read the best matches first without ranking every
+        match
+        @param cursor The database cursor
+        """
+        cursor.execute("""insert into free_text_ids (sid, pid, oid, page)
+            select sid, pid, oid, page from free_text_load
+            order by length, rowid""")
+        cursor.execute("DROP TABLE free_text_load")
+        cursor.execute("insert into free_text(free_text) values ('rebuild')")
+
+    def upgrade(self):
+        """Convert the search index of a database written by an older version
+        of Yuzu (FTS4) to the current one
+        @return False if the database is already up-to-date
+        """
+        conn = sqlite3.connect(self.db)
+        cursor = conn.cursor()
+        cursor.execute("""select count(*) from sqlite_master
+                          where name='free_text_ids'""")
+        upgraded = cursor.fetchone()[0]
+        conn.close()
+        if upgraded:
+            return False
+        with self.replacement() as path:
+            conn = sqlite3.connect(path)
+            self.upgrade_free_text(conn.cursor())
+            conn.commit()
+            conn.execute("VACUUM")
+            conn.close()
+        return True
+
+    @staticmethod
+    def upgrade_free_text(cursor):
+        """Convert an FTS4 search index to the current one (see upgrade)"""
+        cursor.execute("""CREATE TEMP TABLE free_text_load AS
+            select cast(sid as integer) as sid, cast(pid as integer) as pid,
+                   ids.id as oid,
+                   (select page from tripids
+                    where tripids.sid=cast(free_text.sid as integer) and
+                    tripids.pid=cast(free_text.pid as integer) and
+                    tripids.oid=ids.id) as page,
+                   length(object) as length
+            from free_text join ids on ids.n3=free_text.object""")
+        cursor.execute("DROP TABLE free_text")
+        RDFBackend.create_free_text(cursor)
+        RDFBackend.index_free_text(cursor)
+        RDFBackend.create_indexes(cursor)
+
+    # The indexes of the database (name, table and columns)
+    INDEXES = [("subjects", "tripids", "sid"),
+               ("properties", "tripids", "pid, page"),
+               ("objects", "tripids", "oid, page"),
+               ("pages", "tripids", "page"),
+               ("free_text_pages", "free_text_ids", "page")]
+
+    @staticmethod
+    def create_indexes(cursor, timer=None):
+        """Create the indexes of the database
+        @param cursor The database cursor
+        @param timer A LoadTimer to record the time of each index build
+        """
+        for name, table, columns in RDFBackend.INDEXES:
+            with LoadTimer.phase_of(timer, "index " + name):
+                cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" %
+                               (name, table, columns))
+
+    @staticmethod
+    def create_page_table(cursor):
+        """Create the page_triples table, a copy of the triples view that is
+        stored clustered by page, so that a page is read by a single range
+        scan without any joins. Must be called after the indexes are created
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE TABLE page_triples
+                          (page text not null,
+                           seq integer not null,
+                           subject text, subj_label text,
+                           property text, prop_label text,
+                           object text, obj_label text,
+                           head boolean,
+                           primary key (page, seq)) WITHOUT ROWID""")
+        cursor.execute("""insert into page_triples
+            select page, tripids.rowid, subj.n3, subj.label,
+                   prop.n3, prop.label, obj.n3, obj.label, head
+            from tripids indexed by pages
+            join ids as subj on tripids.sid=subj.id
+            join ids as prop on tripids.pid=prop.id
+            join ids as obj on tripids.oid=obj.id
+            where page is not null
+            order by page, tripids.rowid""")
+
+    @staticmethod
+    def create_facet_counts(cursor):
+        """Create the facet_counts table, which holds the number of times
+        each value occurs with each of the FACETS, ordered so that the most
+        common values are read first. Must be called after the indexes are
+        created
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE TABLE facet_counts
+                          (pid integer not null,
+                           oid integer not null,
+                           count integer not null,
+                           primary key (pid, count desc, oid))
+                          WITHOUT ROWID""")
+        cursor.execute("""insert into facet_counts
+            select pid, oid, count(*) from tripids
+            where head=0 and pid in (%s)
+            group by pid, oid""" % ", ".join([TERM_ID_SQL] * len(FACETS)),
+                       [arg for f in FACETS
+                        for arg in split_n3("<%s>" % f["uri"])])
+
+    @staticmethod
+    def create_stats(cursor):
+        """Create the stats table, which holds the (VoID) statistics of the
+        dataset. Each statistic has a name and (for the partitions of the
+        dataset) a key. Must be called after the indexes are created
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE TABLE stats
+                          (name text not null,
+                           key text not null,
+                           value integer not null,
+                           primary key (name, key)) WITHOUT ROWID""")
+        # A triple is stored once for each page it is shown on, so the
+        # duplicates are removed before counting
+        cursor.execute("""insert into stats
+            select 'property', ids.n3, count(*)
+            from (select distinct sid, pid, oid from tripids) as triples
+            join ids on triples.pid=ids.id group by pid""")
+        cursor.execute("""insert into stats
+            select 'class', ids.n3, count(distinct sid)
+            from tripids join ids on tripids.oid=ids.id
+            where pid=%s group by oid""" % TERM_ID_SQL,
+                       split_n3(RDF.type.n3()))
+        cursor.execute("""insert into stats
+            select 'triples', '', coalesce(sum(value), 0) from stats
+            where name='property'""")
+        cursor.execute("""insert into stats
+            select 'properties', '', count(*) from stats
+            where name='property'""")
+        cursor.execute("""insert into stats
+            select 'classes', '', count(*) from stats where name='class'""")
+        cursor.execute("""insert into stats
+            select 'subjects', '', count(distinct sid) from tripids""")
+        cursor.execute("""insert into stats
+            select 'pages', '', count(distinct page) from tripids
+            where page<>'<BLANK>'""")
+        cursor.execute("""insert into stats
+            select 'links', '', coalesce(sum(count), 0) from links
+            where count>=?""", (MIN_LINKS,))
 
     @staticmethod
     def fix_uri(uri):
@@ -471,132 +1158,963 @@ class RDFBackend(Store):
         else:
             return uri
 
-    def load(self, input_stream):
+    def load(self, input_stream, batch_size=100000, processes=1,
+             page_table=PAGE_TABLE):
         """
         Load the resource from an input stream (of NTriples formatted files)
         @param input_stream The input of NTriples
+        @param batch_size The number of lines to insert at once
+        @param processes The number of processes used to parse the input
+        @param page_table If true, also write the page_triples table
         """
-        conn = sqlite3.connect(self.db)
+        timer = LoadTimer()
+        path = self.temp_file()
+        try:
+            triples_read, cache = self.build(path, input_stream, batch_size,
+                                             processes, page_table, timer)
+            self.replace_with(path, timer)
+        except BaseException:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+        timer.report()
+        sys.stderr.write("Term cache: %s\n" % cache.terms.stats())
+        elapsed = timer.elapsed()
+        sys.stderr.write("Loaded %d triples in %.1fs (%.0f triples/sec)\n" %
+                         (triples_read, elapsed,
+                          triples_read / elapsed if elapsed else 0))
+
+    def temp_file(self):
+        """Create an empty file to build a new database in. It is in the
+        same directory as the database so that it can be renamed over it
+        @return The path of the file
+        """
+        fd, path = tempfile.mkstemp(
+            prefix=os.path.basename(self.db) + ".", suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(self.db)))
+        os.close(fd)
+        return path
+
+    @contextmanager
+    def replacement(self, timer=None, check=True):
+        """Copy the database, so that the copy can be changed and then
+        replace the database when the block ends without an error. The
+        database is never written to, so servers may open it as immutable.
+        Only one change (or load) should be made at a time
+        @param timer A LoadTimer to record the time of each step
+        @param check If true, check the integrity of the changed copy
+        @return The path of the copy
+        """
+        path = self.temp_file()
+        try:
+            with LoadTimer.phase_of(timer, "copy"):
+                shutil.copyfile(self.db, path)
+            yield path
+            self.replace_with(path, timer, check)
+        except BaseException:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+
+    def replace_with(self, path, timer=None, check=True):
+        """Check a new database and atomically move it to the path of this
+        database. Queries already running on the old database finish on it,
+        and each thread of a server moves to the new database with its next
+        request (see generation)
+        @param path The path of the new database
+        @param timer A LoadTimer to record the time of each step
+        @param check If true, check the integrity of the new database
+        """
+        if check:
+            with LoadTimer.phase_of(timer, "integrity check"):
+                conn = sqlite3.connect(path)
+                try:
+                    errors = [e for e, in
+                              conn.execute("PRAGMA integrity_check")]
+                finally:
+                    conn.close()
+                if errors != ["ok"]:
+                    raise sqlite3.DatabaseError(
+                        "The new database failed the integrity check: %s" %
+                        "; ".join(errors[:10]))
+        with LoadTimer.phase_of(timer, "swap"):
+            # mkstemp makes the file private to the loading user
+            if os.path.exists(self.db):
+                shutil.copymode(self.db, path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(path, 0o666 & ~umask)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(path, self.db)
+        self.generation()
+
+    def build(self, path, input_stream, batch_size, processes, page_table,
+              timer):
+        """Write a new database from an input stream (see load)
+        @param path The path of the new (empty) database
+        @return The number of triples read and the LoadCache
+        """
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=%d" % SQLITE_LOAD_CACHE_SIZE)
+        conn.execute("PRAGMA threads=%d" % multiprocessing.cpu_count())
         cursor = conn.cursor()
-        self.create_tables(cursor)
+        self.create_tables(cursor, indexes=False)
+        self.create_load_tables(cursor)
 
         cache = LoadCache(cursor)
 
         link_counts = {}
         lines_read = 0
-        for line in input_stream:
-            lines_read += 1
-            if lines_read % 100000 == 0:
+        triples_read = 0
+        parsed = parse_batches(input_stream, batch_size, processes)
+        while True:
+            with timer.phase("parse"):
+                lines, triples = next(parsed, (0, None))
+            if triples is None:
+                break
+            self.load_triples(cursor, cache, triples, link_counts, timer)
+            for _ in range(lines_read // 100000,
+                           (lines_read + lines) // 100000):
                 sys.stderr.write(".")
                 sys.stderr.flush()
-            l = unicode_escape(line.decode('utf-8'))
-            e = l.split(" ")
-            subj_n3 = self.fix_uri(e[0])
-            subj = subj_n3[1:-1]
-            prop = self.fix_uri(e[1])
-            obj = self.fix_uri(" ".join(e[2:-1]))
+            lines_read += lines
+            triples_read += len(triples)
+
+        with timer.phase("links"):
+            # All counts are kept (see link_counts) so that apply_delta can
+            # update them
+            cursor.executemany(
+                """insert into links values (?, ?)""",
+                [(count, target) for target, count in link_counts.items()])
+        if lines_read > 100000:
+            sys.stderr.write("\n")
+
+        with timer.phase("blank nodes"):
+            self.assign_blank_nodes(cursor)
+        with timer.phase("free text"):
+            self.index_free_text(cursor)
+        self.create_indexes(cursor, timer)
+        with timer.phase("facets"):
+            self.create_facet_counts(cursor)
+        with timer.phase("stats"):
+            self.create_stats(cursor)
+        if page_table:
+            with timer.phase("page table"):
+                self.create_page_table(cursor)
+        with timer.phase("optimize"):
+            cursor.execute("""insert into free_text(free_text)
+                              values('optimize')""")
+            cursor.execute("PRAGMA optimize")
+        cursor.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+        with timer.phase("commit"):
+            conn.commit()
+        cursor.close()
+        conn.close()
+        return triples_read, cache
+
+    def apply_delta(self, additions=None, removals=None):
+        """
+        Apply a change to a database made by load. If the server opens the
+        database as immutable (SQLITE_IMMUTABLE), the change is made to a
+        copy of the database, which then replaces it (see replacement), so
+        each change also costs a copy of the whole database. Otherwise the
+        change is made in place, in a single transaction. Apart from the
+        copy, the time taken depends on the size of the change (and of the
+        pages it touches), not on the size of the database. Blank nodes are
+        matched by their labels, so the change must use the labels of the
+        original dump. Triples that are added after the load are ranked
+        after the older ones in the search
+        @param additions The input of NTriples to add (or None)
+        @param removals The input of NTriples to remove (or None)
+        @return The number of triples added and removed
+        """
+        timer = LoadTimer()
+        if SQLITE_IMMUTABLE:
+            with self.replacement(timer, check=False) as path:
+                delta = self.change(path, additions, removals, timer, False)
+        else:
+            delta = self.change(self.db, additions, removals, timer, True)
+            self.generation()
+        timer.report()
+        sys.stderr.write("Added %d and removed %d triples in %.1fs\n" %
+                         (delta.added, delta.removed, timer.elapsed()))
+        return delta.added, delta.removed
+
+    @staticmethod
+    def change(path, additions, removals, timer, in_place):
+        """Apply a change to a database file (see apply_delta)
+        @param path The path of the database
+        @param additions The input of NTriples to add (or None)
+        @param removals The input of NTriples to remove (or None)
+        @param timer A LoadTimer to record the time of each step
+        @param in_place If true, the database may be in use, so the change
+        is journalled as usual, otherwise the journal is turned off
+        @return The DeltaLoad
+        """
+        conn = sqlite3.connect(path)
+        try:
+            if not in_place:
+                conn.execute("PRAGMA journal_mode=OFF")
+                conn.execute("PRAGMA synchronous=OFF")
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA user_version")
+            version, = cursor.fetchone()
+            cursor.execute("""select count(*) from sqlite_master
+                              where name='free_text_ids'""")
+            if version < SCHEMA_VERSION or not cursor.fetchone()[0]:
+                raise ValueError("The database was created by an older "
+                                 "version of Yuzu and must be loaded again")
+            delta = DeltaLoad(cursor)
+            base = "<" + BASE_NAME
+            for stream, apply in [(removals, delta.remove),
+                                  (additions, delta.add)]:
+                if stream is None:
+                    continue
+                with timer.phase("removals" if apply == delta.remove
+                                 else "additions"):
+                    for line in stream:
+                        triple = parse_ntriple(line)
+                        if triple and (triple[0].startswith(base) or
+                                       triple[0].startswith("_:") or
+                                       triple[2].startswith(base)):
+                            apply(triple)
+            delta.finish(timer)
+            with timer.phase("commit"):
+                conn.commit()
+        finally:
+            conn.close()
+        return delta
+
+    @staticmethod
+    def create_load_tables(cursor):
+        """Create the temporary tables that load_triples collects the blank
+        nodes and the text to index in
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE TEMP TABLE free_text_load
+                          (sid integer, pid integer, oid integer,
+                           page text, length integer)""")
+        cursor.execute("""CREATE TEMP TABLE blank_triples
+                          (sid integer, pid integer, oid integer,
+                           blank boolean)""")
+        cursor.execute("""CREATE TEMP TABLE blank_refs
+                          (bid integer, page text)""")
+
+    @staticmethod
+    def assign_blank_nodes(cursor):
+        """Store the triples of each blank node collected by load_triples
+        under every page it can be reached from, so that a page and its blank
+        nodes are read by a single scan of the pages index. Blank nodes that
+        no page refers to are stored under <BLANK>. The copy under the first
+        page has head=1 and the other copies head=2, so that queries can read
+        each triple once
+        @param cursor The database cursor
+        """
+        cursor.execute("""CREATE INDEX temp.blank_subjects
+                          ON blank_triples (sid)""")
+        cursor.execute("""CREATE TEMP TABLE blank_owners
+                          (page text, bid integer, primary key (page, bid))
+                          WITHOUT ROWID""")
+        # The union (not union all) stops on cycles
+        cursor.execute("""insert into blank_owners
+            with recursive owners(bid, page) as (
+                select bid, page from blank_refs
+                union
+                select oid, owners.page from owners
+                join blank_triples on blank_triples.sid=owners.bid
+                where blank_triples.blank)
+            select page, bid from owners""")
+        cursor.execute("""CREATE INDEX temp.owned_blanks
+                          ON blank_owners (bid)""")
+        cursor.execute("""insert into tripids
+            select sid, pid, oid, page,
+            case when page=(select min(page) from blank_owners as first
+                            where first.bid=blank_owners.bid) then 1 else 2 end
+            from blank_owners
+            cross join blank_triples on blank_triples.sid=blank_owners.bid""")
+        cursor.execute("""insert into tripids
+            select sid, pid, oid, '<BLANK>', 1 from blank_triples
+            where sid not in (select bid from blank_owners)""")
+        for table in ["blank_owners", "blank_triples", "blank_refs"]:
+            cursor.execute("DROP TABLE %s" % table)
 
+    def load_triples(self, cursor, cache, triples, link_counts, timer=None):
+        """Insert a batch of triples
+        @param cursor The database cursor
+        @param cache The LoadCache
+        @param triples The list of triples (as N3)
+        @param link_counts The counts of links to other datasets (updated)
+        @param timer A LoadTimer to record the time of each step
+        """
+        base = "<" + BASE_NAME
+        triples = [t for t in triples
+                   if t[0].startswith(base) or t[0].startswith("_:") or
+                   t[2].startswith(base)]
+        terms = []
+        seen = set()
+        for triple in triples:
+            for term in triple:
+                if term not in seen:
+                    seen.add(term)
+                    terms.append(term)
+        with LoadTimer.phase_of(timer, "terms"):
+            ids = cache.get_many(terms)
+
+        facets = set("<%s>" % f["uri"] for f in FACETS)
+        tripids = []
+        blank_triples = []
+        blank_refs = []
+        free_text = []
+        labels = {}
+        for subj_n3, prop, obj in triples:
+            sid, pid, oid = ids[subj_n3], ids[prop], ids[obj]
+            subj = subj_n3[1:-1]
             if subj.startswith(BASE_NAME):
                 id, frag = self.split_uri(subj)
-                cursor.execute("insert into tripids values (?, ?, ?, ?, ?)",
-                               (cache.get(subj_n3), cache.get(prop),
-                                cache.get(obj), id, bool(frag)))
-                if (len([f for f in FACETS if f["uri"] == prop[1:-1]]) > 0 or
-                        obj.startswith('"')):
-                    cursor.execute("insert into free_text values (?, ?, ?)",
-                                   (cache.get(subj_n3), cache.get(prop),
-                                    obj))
-                if prop in LABELS and frag == "":
-                    label = obj[obj.index('"')+1:obj.rindex('"')]
+                tripids.append((sid, pid, oid, id, bool(frag)))
+                if obj.startswith("_:"):
+                    blank_refs.append((oid, id))
+                if prop in facets or obj.startswith('"'):
+                    free_text.append((sid, pid, oid, id, len(obj)))
+                if prop in LABELS and frag == "" and obj.startswith('"'):
+                    label = unescape_literal(
+                        obj[obj.index('"')+1:obj.rindex('"')])
                     if label:
-                        cursor.execute(
-                            "update ids set label=? where id=?",
-                            (label, cache.get(subj_n3)))
-
-                if obj.startswith("<"):
-                    obj_uri = obj[1:-1]
-
-                    ignore = obj_uri.startswith(BASE_NAME)
-                    for link in NOT_LINKED:
-                        if obj_uri.startswith(link):
-                            ignore = True
-                    if not obj_uri.startswith("http"):
-                        ignore = True
-                    if not ignore:
-                        up = urlparse(obj_uri)
-                        target = "%s://%s/" % (up.scheme, up.netloc)
-                        for ls in LINKED_SETS:
-                            if obj_uri.startswith(ls):
-                                target = ls
-
-                        if target in link_counts:
-                            link_counts[target] += 1
-                        else:
-                            link_counts[target] = 1
+                        labels[sid] = label
+
+                target = self.link_target(obj)
+                if target:
+                    if target in link_counts:
+                        link_counts[target] += 1
+                    else:
+                        link_counts[target] = 1
 
             elif subj_n3.startswith("_:"):
-                cursor.execute("insert into tripids values (?, ?, ?, ?, 1)",
-                               (cache.get(subj_n3), cache.get(prop),
-                                cache.get(obj), "<BLANK>"))
+                # Stored under their pages by assign_blank_nodes
+                blank_triples.append((sid, pid, oid, obj.startswith("_:")))
             if obj.startswith("<" + BASE_NAME):
                 id, frag = self.split_uri(obj[1:-1])
-                cursor.execute("insert into tripids values (?, ?, ?, ?, 1)",
-                               (cache.get(subj_n3), cache.get(prop),
-                                cache.get(obj), id))
-
-        for target, count in link_counts.items():
-            if count >= MIN_LINKS:
-                cursor.execute(
-                    """insert into links values (?, ?)""", (count, target))
-        if lines_read > 100000:
-            sys.stderr.write("\n")
+                tripids.append((sid, pid, oid, id, 1))
+
+        with LoadTimer.phase_of(timer, "tripids"):
+            cursor.executemany("insert into tripids values (?, ?, ?, ?, ?)",
+                               tripids)
+            cursor.executemany("insert into blank_triples values (?, ?, ?, ?)",
+                               blank_triples)
+            cursor.executemany("insert into blank_refs values (?, ?)",
+                               blank_refs)
+        with LoadTimer.phase_of(timer, "free text"):
+            cursor.executemany(
+                "insert into free_text_load values (?, ?, ?, ?, ?)",
+                free_text)
+        with LoadTimer.phase_of(timer, "labels"):
+            cursor.executemany("update terms set label=? where id=?",
+                               [(labels[sid], sid) for sid in sorted(labels)])
 
-        conn.commit()
+    def stat(self, name, key=""):
+        """Read a statistic of the dataset (as written by the loader)
+        @param name The name of the statistic, e.g., triples
+        @param key The key of the partition, e.g., the N3 of a property
+        @return The value or None if it was not recorded
+        """
+        if not self.pool.has_table("stats"):
+            return None
+        cursor = self.connection().cursor()
+        cursor.execute("select value from stats where name=? and key=?",
+                       (name, key))
+        row = cursor.fetchone()
         cursor.close()
-        conn.close()
+        return row[0] if row else None
+
+    def stat_partitions(self, name):
+        """Read the partitions of the dataset
+        @param name The kind of partition (property or class)
+        @return A list of the key (as N3) and the value of each partition
+        """
+        if not self.pool.has_table("stats"):
+            return []
+        cursor = self.connection().cursor()
+        cursor.execute("""select key, value from stats where name=?
+                          order by key""", (name,))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
 
     def triple_count(self):
-        try:
-            return self._triple_count
-        except AttributeError:
-            conn = sqlite3.connect(self.db)
-            cursor = conn.cursor()
+        count = self.stat("triples")
+        if count is None:
+            cursor = self.connection().cursor()
             cursor.execute("select count(*) from tripids")
             count, = cursor.fetchone()
-            self._triple_count = count
             cursor.close()
-            conn.close()
-            return count
+        return count
 
     def link_counts(self):
-        conn = sqlite3.connect(self.db)
-        cursor = conn.cursor()
-        cursor.execute("select count, target from links")
+        cursor = self.connection().cursor()
+        cursor.execute("select count, target from links where count>=?",
+                       (MIN_LINKS,))
         try:
             for c, t in cursor.fetchall():
                 yield (t, c)
         finally:
             cursor.close()
-            conn.close()
 
 
-def unicode_escape(s):
-    i = 0
-    while i < len(s):
-        if s[i:i+2] == "\\u":
-            if sys.version_info[0] < 3:
-                s = s[:i] + unichr(int(s[i+2:i+6], 16)) + s[i+6:]
+class DeltaLoad:
+    """Applies a change (triples to add and to remove) to an existing
+    database, see RDFBackend.apply_delta. The triples are changed one at a
+    time and the tables derived from them are only updated for the pages,
+    terms and blank nodes that the change touches"""
+    def __init__(self, cursor):
+        """Start a change
+        @param cursor The database cursor (in a transaction)
+        """
+        self.cursor = cursor
+        self.cache = LoadCache(cursor)
+        self.facets = set("<%s>" % f["uri"] for f in FACETS)
+        # The presence of each touched page and subject before the change
+        self.pages = {}
+        self.subjects = {}
+        # The blank nodes whose owners may have changed
+        self.blanks = set()
+        # The subjects whose label may have changed
+        self.labels = set()
+        # The (pid, oid) of the facet values whose count changed
+        self.facet_values = set()
+        # The classes whose number of entities may have changed (and the id
+        # of rdf:type, once it is seen)
+        self.classes = set()
+        self.type_id = None
+        # The change in the number of triples of each property and the
+        # number of links to each dataset
+        self.properties = {}
+        self.links = {}
+        self.added = 0
+        self.removed = 0
+
+    def touch_page(self, page):
+        if page not in self.pages:
+            self.cursor.execute("select 1 from tripids where page=? limit 1",
+                                (page,))
+            self.pages[page] = self.cursor.fetchone() is not None
+
+    def touch_subject(self, sid):
+        if sid not in self.subjects:
+            self.cursor.execute("select 1 from tripids where sid=? limit 1",
+                                (sid,))
+            self.subjects[sid] = self.cursor.fetchone() is not None
+
+    def exists(self, sid, pid, oid):
+        self.cursor.execute("""select 1 from tripids
+                               where sid=? and pid=? and oid=? limit 1""",
+                            (sid, pid, oid))
+        return self.cursor.fetchone() is not None
+
+    def count(self, counts, key, change):
+        counts[key] = counts.get(key, 0) + change
+
+    def delete_row(self, sid, pid, oid, page, head):
+        """Delete a single copy of a row of tripids"""
+        self.touch_page(page)
+        self.cursor.execute("""delete from tripids where rowid=
+            (select rowid from tripids where sid=? and pid=? and oid=? and
+             page=? and head=? limit 1)""", (sid, pid, oid, page, head))
+
+    def insert_row(self, sid, pid, oid, page, head):
+        self.touch_page(page)
+        self.cursor.execute("insert into tripids values (?, ?, ?, ?, ?)",
+                            (sid, pid, oid, page, head))
+
+    def remove(self, triple):
+        """Remove a triple
+        @param triple The subject, property and object as N3
+        @return True if the triple was in the database
+        """
+        subj, prop, obj = triple
+        ids = self.cache.find(set(triple))
+        if len(ids) < len(set(triple)):
+            return False
+        sid, pid, oid = ids[subj], ids[prop], ids[obj]
+        if not self.exists(sid, pid, oid):
+            return False
+        self.touch_subject(sid)
+        if subj.startswith("_:"):
+            # Every copy is removed, the rest are rewritten by finish
+            self.cursor.execute("""select distinct page from tripids
+                                   where sid=? and pid=? and oid=?
+                                   and page is not null""",
+                                (sid, pid, oid))
+            for page, in self.cursor.fetchall():
+                self.touch_page(page)
+            self.cursor.execute("""delete from tripids
+                                   where sid=? and pid=? and oid=?""",
+                                (sid, pid, oid))
+            self.blanks.add(sid)
+            if obj.startswith("_:"):
+                self.blanks.add(oid)
+        else:
+            if subj.startswith("<" + BASE_NAME):
+                id, frag = RDFBackend.split_uri(subj[1:-1])
+                self.delete_row(sid, pid, oid, id, bool(frag))
+                self.page_triple_changed(triple, sid, pid, oid, id, frag, -1)
+            if obj.startswith("<" + BASE_NAME):
+                id, _ = RDFBackend.split_uri(obj[1:-1])
+                self.delete_row(sid, pid, oid, id, 1)
+        self.triple_changed(prop, pid, oid, -1)
+        self.removed += 1
+        return True
+
+    def add(self, triple):
+        """Add a triple
+        @param triple The subject, property and object as N3
+        @return True if the triple was not already in the database
+        """
+        subj, prop, obj = triple
+        ids = self.cache.get_many(list(set(triple)))
+        sid, pid, oid = ids[subj], ids[prop], ids[obj]
+        if self.exists(sid, pid, oid):
+            return False
+        self.touch_subject(sid)
+        if subj.startswith("_:"):
+            # Stored under its owners by finish, until then under no page
+            self.cursor.execute("insert into tripids values (?, ?, ?, ?, ?)",
+                                (sid, pid, oid, None, 1))
+            self.blanks.add(sid)
+            if obj.startswith("_:"):
+                self.blanks.add(oid)
+        else:
+            if subj.startswith("<" + BASE_NAME):
+                id, frag = RDFBackend.split_uri(subj[1:-1])
+                self.insert_row(sid, pid, oid, id, bool(frag))
+                self.page_triple_changed(triple, sid, pid, oid, id, frag, 1)
+            if obj.startswith("<" + BASE_NAME):
+                id, _ = RDFBackend.split_uri(obj[1:-1])
+                self.insert_row(sid, pid, oid, id, 1)
+        self.triple_changed(prop, pid, oid, 1)
+        self.added += 1
+        return True
+
+    def triple_changed(self, prop, pid, oid, change):
+        self.count(self.properties, pid, change)
+        if prop == RDF.type.n3():
+            self.type_id = pid
+            self.classes.add(oid)
+
+    def page_triple_changed(self, triple, sid, pid, oid, id, frag, change):
+        """Update the search index, labels, facets and links for a triple
+        whose subject is a page"""
+        subj, prop, obj = triple
+        if obj.startswith("_:"):
+            self.blanks.add(oid)
+        if prop in self.facets or obj.startswith('"'):
+            if change > 0:
+                self.cursor.execute("""insert into free_text_ids
+                    (sid, pid, oid, page) values (?, ?, ?, ?)""",
+                                    (sid, pid, oid, id))
+                self.cursor.execute("""insert into free_text
+                    (rowid, sid, pid, object) values (?, ?, ?, ?)""",
+                                    (self.cursor.lastrowid, sid, pid, obj))
             else:
-                s = s[:i] + chr(int(s[i+2:i+6], 16)) + s[i+6:]
-        i += 1
-    return s
+                self.cursor.execute("""select rowid from free_text_ids
+                    where page=? and sid=? and pid=? and oid=? limit 1""",
+                                    (id, sid, pid, oid))
+                for rowid, in self.cursor.fetchall():
+                    self.cursor.execute("""insert into free_text
+                        (free_text, rowid, sid, pid, object)
+                        values ('delete', ?, ?, ?, ?)""",
+                                        (rowid, sid, pid, obj))
+                    self.cursor.execute(
+                        "delete from free_text_ids where rowid=?", (rowid,))
+        if prop in LABELS and frag == "" and obj.startswith('"'):
+            self.labels.add(sid)
+        if prop in self.facets and frag == "":
+            self.facet_values.add((pid, oid))
+        target = RDFBackend.link_target(obj)
+        if target:
+            self.count(self.links, target, change)
+
+    def finish(self, timer=None):
+        """Update the tables derived from the triples
+        @param timer A LoadTimer to record the time of each step
+        """
+        with LoadTimer.phase_of(timer, "blank nodes"):
+            self.assign_blank_nodes()
+        with LoadTimer.phase_of(timer, "labels"):
+            self.update_labels()
+        with LoadTimer.phase_of(timer, "facets"):
+            self.update_facet_counts()
+        with LoadTimer.phase_of(timer, "links"):
+            for target, change in self.links.items():
+                self.cursor.execute("""update links set count=count+?
+                                       where target=?""", (change, target))
+                if not self.cursor.rowcount:
+                    self.cursor.execute("insert into links values (?, ?)",
+                                        (change, target))
+            self.cursor.execute("delete from links where count<=0")
+        with LoadTimer.phase_of(timer, "stats"):
+            self.update_stats()
+        with LoadTimer.phase_of(timer, "page table"):
+            self.update_page_table()
+
+    def assign_blank_nodes(self):
+        """Store the triples of the touched blank nodes (and the blank nodes
+        below them) under the pages they can now be reached from, as
+        RDFBackend.assign_blank_nodes does for a full load"""
+        if not self.blanks:
+            return
+        cursor = self.cursor
+        cursor.execute("CREATE TEMP TABLE delta_seeds (bid integer)")
+        cursor.executemany("insert into delta_seeds values (?)",
+                           [(b,) for b in self.blanks])
+        # The blank nodes to rewrite
+        cursor.execute("""CREATE TEMP TABLE delta_blanks AS
+            with recursive down(bid) as (
+                select bid from delta_seeds
+                union
+                select tripids.oid from down
+                join tripids on tripids.sid=down.bid
+                join ids on tripids.oid=ids.id
+                where substr(ids.n3, 1, 2)='_:')
+            select bid from down""")
+        # ... and the blank nodes above them, which they inherit owners from
+        cursor.execute("""CREATE TEMP TABLE delta_ancestors AS
+            with recursive up(bid) as (
+                select bid from delta_blanks
+                union
+                select tripids.sid from up
+                join tripids on tripids.oid=up.bid
+                join ids on tripids.sid=ids.id
+                where substr(ids.n3, 1, 2)='_:')
+            select bid from up""")
+        cursor.execute("""CREATE TEMP TABLE delta_owners AS
+            with recursive owners(bid, page) as (
+                select tripids.oid, tripids.page from tripids
+                join ids on tripids.sid=ids.id
+                where tripids.oid in (select bid from delta_ancestors)
+                and substr(ids.n3, 1, 2)<>'_:'
+                union
+                select tripids.oid, owners.page from owners
+                join tripids on tripids.sid=owners.bid
+                join ids on tripids.oid=ids.id
+                where substr(ids.n3, 1, 2)='_:')
+            select bid, page from owners
+            where bid in (select bid from delta_blanks)""")
+        cursor.execute("""CREATE INDEX temp.delta_owned
+                          ON delta_owners (bid)""")
+        cursor.execute("""CREATE TEMP TABLE delta_blank_triples AS
+            select distinct sid, pid, oid from tripids
+            where sid in (select bid from delta_blanks)""")
+        cursor.execute("""select distinct page from tripids
+                          where sid in (select bid from delta_blanks)
+                          and page is not null
+                          union select page from delta_owners""")
+        for page, in cursor.fetchall():
+            self.touch_page(page)
+        cursor.execute("""delete from tripids
+                          where sid in (select bid from delta_blanks)""")
+        cursor.execute("""insert into tripids
+            select sid, pid, oid, page,
+            case when page=(select min(page) from delta_owners as first
+                            where first.bid=delta_owners.bid) then 1 else 2 end
+            from delta_owners
+            join delta_blank_triples on delta_blank_triples.sid=
+                delta_owners.bid""")
+        # <BLANK> is only rewritten if it gains (or loses) blank nodes
+        cursor.execute("""select 1 from delta_blank_triples
+            where sid not in (select bid from delta_owners) limit 1""")
+        if cursor.fetchone():
+            self.touch_page('<BLANK>')
+        cursor.execute("""insert into tripids
+            select sid, pid, oid, '<BLANK>', 1 from delta_blank_triples
+            where sid not in (select bid from delta_owners)""")
+        # The copies stored under the pages the blank nodes link to
+        cursor.execute("""select sid, pid, oid, ids.n3
+            from delta_blank_triples join ids on oid=ids.id
+            where substr(ids.n3, 1, %d)=?""" % (len(BASE_NAME) + 1),
+                       ("<" + BASE_NAME,))
+        for sid, pid, oid, obj in cursor.fetchall():
+            id, _ = RDFBackend.split_uri(obj[1:-1])
+            self.insert_row(sid, pid, oid, id, 1)
+        for table in ["delta_seeds", "delta_blanks", "delta_ancestors",
+                      "delta_owners", "delta_blank_triples"]:
+            cursor.execute("DROP TABLE %s" % table)
+
+    def update_labels(self):
+        """Set the label of each touched subject to its last label, as load
+        does. The pages that show a changed label are touched"""
+        for sid in self.labels:
+            self.cursor.execute("""select obj.n3 from tripids
+                join ids as prop on tripids.pid=prop.id
+                join ids as obj on tripids.oid=obj.id
+                where sid=? and head=0 and prop.n3 in (%s)
+                and substr(obj.n3, 1, 1)='"'
+                order by tripids.rowid""" % ", ".join("?" * len(LABELS)),
+                                [sid] + list(LABELS))
+            label = None
+            for obj, in self.cursor.fetchall():
+                label = unescape_literal(
+                    obj[obj.index('"')+1:obj.rindex('"')]) or label
+            self.cursor.execute("""update terms set label=?
+                                   where id=? and label is not ?""",
+                                (label, sid, label))
+            if self.cursor.rowcount:
+                self.cursor.execute("""select distinct page from tripids
+                                       where sid=? or pid=? or oid=?""",
+                                    (sid, sid, sid))
+                for page, in self.cursor.fetchall():
+                    self.touch_page(page)
+
+    def has_table(self, name):
+        self.cursor.execute("""select count(*) from sqlite_master
+                               where name=?""", (name,))
+        return self.cursor.fetchone()[0] > 0
+
+    def update_facet_counts(self):
+        if not self.has_table("facet_counts"):
+            return
+        for pid, oid in self.facet_values:
+            self.cursor.execute("""delete from facet_counts
+                                   where pid=? and oid=?""", (pid, oid))
+            self.cursor.execute("""insert into facet_counts
+                select pid, oid, count(*) from tripids
+                where pid=? and oid=? and head=0 group by pid, oid""",
+                                (pid, oid))
+
+    def set_stat(self, name, key, value):
+        self.cursor.execute("delete from stats where name=? and key=?",
+                            (name, key))
+        if value or not key:
+            self.cursor.execute("insert into stats values (?, ?, ?)",
+                                (name, key, value))
+
+    def stat(self, name, key=""):
+        self.cursor.execute("select value from stats where name=? and key=?",
+                            (name, key))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def update_stats(self):
+        if not self.has_table("stats"):
+            return
+        cursor = self.cursor
+        cursor.execute("""select id, n3 from ids where id in (%s)""" %
+                       ", ".join("?" * len(self.properties)),
+                       list(self.properties))
+        for pid, n3 in cursor.fetchall():
+            self.set_stat("property", n3, self.stat("property", n3) +
+                          self.properties[pid])
+        for oid in self.classes:
+            cursor.execute("""select ids.n3, count(distinct sid) from ids
+                left join tripids on tripids.oid=ids.id and tripids.pid=?
+                where ids.id=?""", (self.type_id, oid))
+            n3, count = cursor.fetchone()
+            self.set_stat("class", n3, count)
+        self.set_stat("triples", "", self.stat("triples") +
+                      self.added - self.removed)
+        for name, key in [("properties", "property"), ("classes", "class")]:
+            cursor.execute("select count(*) from stats where name=?", (key,))
+            self.set_stat(name, "", cursor.fetchone()[0])
+        for name, before, test in [
+                ("subjects", self.subjects, "sid"),
+                ("pages", self.pages, "page")]:
+            change = 0
+            for key, present in before.items():
+                if key == '<BLANK>':
+                    continue
+                cursor.execute("select 1 from tripids where %s=? limit 1" %
+                               test, (key,))
+                change += (cursor.fetchone() is not None) - present
+            self.set_stat(name, "", self.stat(name) + change)
+        cursor.execute("""select coalesce(sum(count), 0) from links
+                          where count>=?""", (MIN_LINKS,))
+        self.set_stat("links", "", cursor.fetchone()[0])
+
+    def update_page_table(self):
+        """Copy the touched pages to page_triples again"""
+        if not self.has_table("page_triples"):
+            return
+        for page in self.pages:
+            self.cursor.execute("delete from page_triples where page=?",
+                                (page,))
+            self.cursor.execute("""insert into page_triples
+                select page, tripids.rowid, subj.n3, subj.label,
+                       prop.n3, prop.label, obj.n3, obj.label, head
+                from tripids
+                join ids as subj on tripids.sid=subj.id
+                join ids as prop on tripids.pid=prop.id
+                join ids as obj on tripids.oid=obj.id
+                where page=? order by tripids.rowid""", (page,))
+
+
+def encode_token(key):
+    """Encode the sort key of a result as an (opaque) continuation token
+    @param key The sort key, as a list
+    @return The token, which is safe to use in a URL
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token, types):
+    """Decode a continuation token
+    @param token The token, as produced by encode_token
+    @param types The type of each element of the sort key, e.g., [str, int]
+    @return The sort key
+    @throws ValueError If the token is not valid or the key is not of the
+    given types
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Bad continuation token: %s" % token)
+    if (not isinstance(key, list) or len(key) != len(types) or
+            not all(_TOKEN_TYPES[t](k) for k, t in zip(key, types))):
+        raise ValueError("Bad continuation token: %s" % token)
+    return key
+
+
+# The checks of the elements of a sort key (JSON strings are unicode on
+# Python 2 and booleans are also ints)
+_TOKEN_TYPES = {
+    str: lambda k: isinstance(k, (type(u""), str)),
+    int: lambda k: (isinstance(k, numbers.Integral) and
+                    not isinstance(k, bool))
+}
+
+
+# The operators of the FTS5 query syntax that are kept in user queries
+FTS_OPERATORS = ("AND", "OR", "NOT")
+
+
+def fts_query(query):
+    """Convert a user's query to an FTS5 query. Each word is quoted, so that
+    punctuation is not read as query syntax, except for a trailing * (for
+    prefix queries) and the operators AND, OR and NOT between two words
+    @param query The query
+    @return The FTS5 query
+    """
+    words = query.split()
+    terms = []
+    for i, word in enumerate(words):
+        if (word in FTS_OPERATORS and terms and i + 1 < len(words) and
+                terms[-1] not in FTS_OPERATORS):
+            terms.append(word)
+            continue
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'),
+                                     "*" if prefix else ""))
+    return " ".join(terms)
+
+
+def open_ntriples(path):
+    """Open an N-Triples file, which may be compressed with gzip
+    @param path The path to the file
+    @return The file (reading bytes)
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path)
+    else:
+        return open(path, "rb")
+
+
+def fetch_rows(cursor):
+    """Iterate over the rows of a query as they are read, closing the cursor
+    at the end
+    @param cursor The cursor of an executed query
+    @return A generator of rows
+    """
+    try:
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+if sys.version_info[0] < 3:
+    _chr = unichr
+else:
+    _chr = chr
+
+# Escaped backslashes, surrogate pairs and numeric escapes in N-Triples
+_UCHAR = re.compile(r"\\\\|\\u([Dd][89ABab][0-9A-Fa-f]{2})"
+                    r"\\u([Dd][C-Fc-f][0-9A-Fa-f]{2})"
+                    r"|\\u([0-9A-Fa-f]{4})|\\U([0-9A-Fa-f]{8})")
+# All escapes allowed in an N-Triples literal
+_ECHAR = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})"
+                    r"|([tbnrf\"'\\]))")
+_ECHARS = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f",
+           "\"": "\"", "'": "'", "\\": "\\"}
+
+
+def _code_point(hex_digits, escape):
+    code = int(hex_digits, 16)
+    if code > 0x10FFFF:
+        return escape
+    return _chr(code)
+
+
+def _decode_uchar(match):
+    high, low, u, big_u = match.groups()
+    if high:
+        return _chr(0x10000 + ((int(high, 16) - 0xD800) << 10) +
+                    (int(low, 16) - 0xDC00))
+    elif u or big_u:
+        return _code_point(u or big_u, match.group(0))
+    else:
+        return match.group(0)
+
+
+def unicode_escape(s):
+    """Decode the numeric escapes (\\uXXXX and \\UXXXXXXXX) of an N-Triples
+    string in a single pass. Other escapes (such as \\" or \\\\) are kept, so
+    that a term stays valid N3
+    @param s The string
+    @return The decoded string
+    """
+    if "\\" not in s:
+        return s
+    return _UCHAR.sub(_decode_uchar, s)
+
+
+def _decode_echar(match):
+    u, big_u, char = match.groups()
+    if char:
+        return _ECHARS[char]
+    else:
+        return _code_point(u or big_u, match.group(0))
+
+
+def unescape_literal(s):
+    """Decode all the escapes of the text of an N-Triples literal
+    @param s The literal text (without quotes)
+    @return The decoded text
+    """
+    if "\\" not in s:
+        return s
+    return _ECHAR.sub(_decode_echar, s)
+
 
 if __name__ == "__main__":
-    opts = dict(getopt.getopt(sys.argv[1:], 'd:f:')[0])
+    opts = dict(getopt.getopt(sys.argv[1:], 'a:d:f:j:pr:u')[0])
     backend = RDFBackend(opts.get('-d', DB_FILE))
-    input_file = opts.get('-f', DUMP_FILE)
-    if input_file.endswith(".gz"):
-        input_stream = gzip.open(input_file)
-    else:
-        input_stream = open(input_file)
-    backend.load(input_stream)
+    if '-u' in opts:
+        if not backend.upgrade():
+            sys.stderr.write("The database is already up-to-date\n")
+        sys.exit(0)
+    if '-a' in opts or '-r' in opts:
+        backend.apply_delta(*[open_ntriples(opts[o]) if o in opts else None
+                              for o in ['-a', '-r']])
+        sys.exit(0)
+    input_stream = open_ntriples(opts.get('-f', DUMP_FILE))
+    backend.load(input_stream, processes=int(opts.get('-j', 1)),
+                 page_table=PAGE_TABLE or '-p' in opts)
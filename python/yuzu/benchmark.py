@@ -0,0 +1,234 @@
+import getopt
+import os
+import sys
+import tempfile
+import time
+from wsgiref.util import setup_testing_defaults
+
+import yuzu.backend
+from yuzu.backend import RDFBackend, unicode_escape
+from yuzu.cache import TERMS
+from yuzu.server import RDFServer
+from yuzu.settings import BASE_NAME
+
+__author__ = 'John P. McCrae'
+
+
+def synthetic_dump(resources, blanks=0):
+    """Generate a synthetic N-Triples dump, similar in shape to a typical
+    lexical dataset (labels, types, links, fragments and blank nodes)
+    @param resources The number of pages to generate
+    @param blanks The number of extra (nested) blank node records to attach
+    to each page
+    @return A generator of N-Triples lines (as bytes)
+    """
+    label = "<http://www.w3.org/2000/01/rdf-schema#label>"
+    rdf_type = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+    see_also = "<http://www.w3.org/2000/01/rdf-schema#seeAlso>"
+    link = "<%sontology#link>" % BASE_NAME
+    sense = "<%sontology#sense>" % BASE_NAME
+    gloss = "<%sontology#gloss>" % BASE_NAME
+    record = "<%sontology#record>" % BASE_NAME
+    source = "<%sontology#source>" % BASE_NAME
+    for i in range(resources):
+        subj = "<%sdata/r%d>" % (BASE_NAME, i)
+        lines = [
+            (subj, label, "\"Resource number %d\"@en" % i),
+            (subj, label, "\"Ressource Nummer %d\"@de" % i),
+            (subj, rdf_type, "<%sontology#Class%d>" % (BASE_NAME, i % 10)),
+            (subj, see_also, "<http://dbpedia.org/resource/R%d>" % i),
+            (subj, link,
+             "<%sdata/r%d>" % (BASE_NAME, (i * 7 + 1) % resources)),
+            (subj, sense, "<%sdata/r%d#sense1>" % (BASE_NAME, i)),
+            ("<%sdata/r%d#sense1>" % (BASE_NAME, i), gloss, "_:g%d" % i),
+            ("_:g%d" % i, label, "\"A gloss of resource %d\"" % i),
+            ("_:g%d" % i, see_also, "_:h%d" % i),
+            ("_:h%d" % i, label, "\"A nested note about %d\"" % i)]
+        for j in range(blanks):
+            node = "_:p%dx%d" % (i, j)
+            lines.extend([
+                (subj, record, node),
+                (node, label, "\"Record %d of resource %d\"" % (j, i)),
+                (node, source, node + "s"),
+                (node + "s", label, "\"Source of record %d\"" % j),
+                (node + "s", see_also,
+                 "<http://dbpedia.org/resource/S%d>" % j)])
+        for s, p, o in lines:
+            yield ("%s %s %s .\n" % (s, p, o)).encode('utf-8')
+
+
+def wsgi_get(server, path, query_string="", accept="text/html"):
+    """Perform a single GET request against a server without a socket
+    @param server The RDFServer
+    @param path The path to request
+    @return The status line and the response body
+    """
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query_string,
+               'HTTP_ACCEPT': accept}
+    setup_testing_defaults(environ)
+    status = []
+
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+
+    body = b"".join(chunk if isinstance(chunk, bytes)
+                    else chunk.encode('utf-8')
+                    for chunk in server.application(environ, start_response))
+    return status[0], body
+
+
+def requests_per_second(server, path, query_string="", requests=200):
+    """Measure the throughput of a single route
+    @param server The RDFServer
+    @param path The path to request
+    @param requests The number of requests to make
+    @return The number of requests served per second
+    """
+    wsgi_get(server, path, query_string)
+    start = time.time()
+    for _ in range(requests):
+        wsgi_get(server, path, query_string)
+    return requests / (time.time() - start)
+
+
+def bench_routes(db, resources, requests):
+    server = RDFServer(db)
+    for path, qs in [("/list/", ""),
+                     ("/list/", "offset=%d" % (resources // 2)),
+                     ("/data/r%d" % (resources // 2), ""),
+                     ("/search", "query=resource")]:
+        rate = requests_per_second(server, path, qs, requests)
+        print("%-30s %8.1f req/s" % (path + ("?" + qs if qs else ""), rate))
+
+
+def percentile(times, p):
+    return sorted(times)[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+
+def latency(label, f, ids):
+    times = []
+    for id in ids:
+        start = time.time()
+        f(id)
+        times.append(time.time() - start)
+    print("%-20s mean %.3fms p50 %.3fms p99 %.3fms" %
+          (label, 1000.0 * sum(times) / len(times),
+           1000.0 * percentile(times, 50), 1000.0 * percentile(times, 99)))
+
+
+def bench_lookup(db, resources, requests):
+    """Measure the latency of fetching single pages from the backend (build
+    the database with -b to give the pages more blank nodes). The time of
+    the query alone is reported as fetch"""
+    backend = RDFBackend(db)
+    ids = ["data/r%d" % ((i * 7919) % resources) for i in range(requests)]
+    latency("fetch", backend.lookup_rows, ids)
+    latency("lookup", backend.lookup, ids)
+    print("Term cache: %s" % TERMS.stats())
+
+
+def bench_layout(resources, requests, blanks):
+    """Compare the size of the database and the latency of page lookups with
+    and without the page_triples table"""
+    tmp = tempfile.mkdtemp()
+    for page_table in [False, True]:
+        db = os.path.join(tmp, "layout%d.db" % page_table)
+        RDFBackend(db).load(synthetic_dump(resources, blanks),
+                            page_table=page_table)
+        print("page table %-5s %d bytes" % (page_table, os.path.getsize(db)))
+        bench_lookup(db, resources, requests)
+        os.unlink(db)
+    os.rmdir(tmp)
+
+
+def bench_open(db, resources, requests):
+    """Compare the latency of page lookups with the database opened for
+    reading as before (locking, with 256MB memory mapped) and opened as
+    immutable with the whole file memory mapped"""
+    settings = (yuzu.backend.SQLITE_IMMUTABLE, yuzu.backend.SQLITE_MMAP_SIZE)
+    # Read the file once, so that neither mode starts with a cold OS cache
+    with open(db, "rb") as f:
+        while f.read(1 << 20):
+            pass
+    for immutable, mmap_size in [(False, 268435456), (True, None)]:
+        yuzu.backend.SQLITE_IMMUTABLE = immutable
+        yuzu.backend.SQLITE_MMAP_SIZE = mmap_size
+        TERMS.clear()
+        print("immutable %s" % immutable)
+        bench_lookup(db, resources, requests)
+    yuzu.backend.SQLITE_IMMUTABLE, yuzu.backend.SQLITE_MMAP_SIZE = settings
+
+
+def bench_unicode_escape(requests):
+    """Measure the decoding of N-Triples lines of increasing length, which
+    should scale linearly"""
+    for length in [100, 1000, 10000, 100000]:
+        line = ("\"caf\\u00E9 \\U0001F600 \\\" ok\" " * length)[:length]
+        start = time.time()
+        for _ in range(requests):
+            unicode_escape(line)
+        elapsed = (time.time() - start) / requests
+        print("unicode_escape %-15s %8.1f us %8.1f MB/s" %
+              ("(%d chars)" % length, elapsed * 1e6,
+               length / elapsed / 1e6 if elapsed else 0.0))
+
+
+def bench_search(db, resources, requests):
+    """Measure the latency of searches for a common word, a prefix, two words
+    and a rare word, and report the size of the search index"""
+    backend = RDFBackend(db)
+    for query in ["resource", "reso*", "Nummer 5*", str(resources - 1)]:
+        latency("search %s" % query, lambda q: backend.search(q, None, 0),
+                [query] * requests)
+    cursor = backend.connection().cursor()
+    try:
+        cursor.execute("""select sum(pgsize) from dbstat
+                          where name like 'free_text%'""")
+        print("Search index: %d bytes" % cursor.fetchone()[0])
+    except Exception:
+        pass
+    cursor.close()
+
+
+def build(db, resources, blanks=0):
+    start = time.time()
+    RDFBackend(db).load(synthetic_dump(resources, blanks))
+    print("Loaded %d resources in %.2fs (%d bytes)" %
+          (resources, time.time() - start, os.path.getsize(db)))
+
+
+SUITES = ["routes", "lookup", "layout", "escape", "search", "open"]
+
+if __name__ == "__main__":
+    opts, suites = getopt.getopt(sys.argv[1:], 'b:d:n:r:')
+    opts = dict(opts)
+    suites = suites or ["routes"]
+    for suite in suites:
+        if suite not in SUITES:
+            sys.stderr.write("Unknown benchmark %s (expected one of %s)\n" %
+                             (suite, ", ".join(SUITES)))
+            sys.exit(-1)
+    resources = int(opts.get('-n', 10000))
+    requests = int(opts.get('-r', 200))
+    blanks = int(opts.get('-b', 0))
+    if '-d' in opts:
+        db = opts['-d']
+    else:
+        db = os.path.join(tempfile.mkdtemp(), "bench.db")
+    if "escape" in suites:
+        bench_unicode_escape(requests)
+    if not os.path.exists(db) and ("routes" in suites or
+                                   "lookup" in suites or
+                                   "search" in suites or
+                                   "open" in suites):
+        build(db, resources, blanks)
+    if "routes" in suites:
+        bench_routes(db, resources, requests)
+    if "lookup" in suites:
+        bench_lookup(db, resources, requests)
+    if "search" in suites:
+        bench_search(db, resources, requests)
+    if "open" in suites:
+        bench_open(db, resources, requests)
+    if "layout" in suites:
+        bench_layout(resources, requests, blanks)
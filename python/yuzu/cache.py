@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from functools import wraps
+import threading
+from rdflib.util import from_n3 as parse_n3
+
+from yuzu.settings import TERM_CACHE_SIZE
+
+__author__ = 'John P. McCrae'
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache, bounded either by the number
+    of entries or by their total size"""
+    def __init__(self, capacity, sizeof=None):
+        """Create a cache
+        @param capacity The maximum total size of the cache, or None for an
+        unbounded cache
+        @param sizeof A function giving the size of an entry from its key and
+        value, or None to count each entry as 1
+        """
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.values = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _size(self, key, value):
+        if self.sizeof:
+            return self.sizeof(key, value)
+        else:
+            return 1
+
+    def get(self, key, default=None):
+        """Get a value from the cache, marking it as recently used
+        @param key The key
+        @param default The value to return if the key is not cached
+        """
+        with self.lock:
+            try:
+                value = self.values.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.values[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Add a value to the cache, evicting the least recently used values
+        if the cache is full
+        @param key The key
+        @param value The value
+        """
+        size = self._size(key, value)
+        if self.capacity is not None and size > self.capacity:
+            return
+        with self.lock:
+            if key in self.values:
+                self.size -= self._size(key, self.values.pop(key))
+            self.values[key] = value
+            self.size += size
+            while self.capacity is not None and self.size > self.capacity:
+                evicted = self.values.popitem(last=False)
+                self.size -= self._size(*evicted)
+
+    def clear(self):
+        """Remove all values from the cache"""
+        with self.lock:
+            self.values.clear()
+            self.size = 0
+
+    def stats(self):
+        """Describe the cache usage as a string"""
+        total = self.hits + self.misses
+        return "%d hits, %d misses (%.1f%% hit rate), %d entries" % (
+            self.hits, self.misses,
+            100.0 * self.hits / total if total else 0.0, len(self.values))
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+
+# The RDF terms parsed from the database, shared by all requests
+TERMS = LRUCache(TERM_CACHE_SIZE)
+
+
+def from_n3(n3):
+    """Parse an RDF term from N3 (as stored in the database), reusing the
+    term if it was parsed recently. RDFlib terms are immutable so a single
+    instance can be shared by all requests
+    @param n3 The term as N3
+    @return The RDFlib term
+    """
+    term = TERMS.get(n3)
+    if term is None:
+        term = parse_n3(n3)
+        TERMS.put(n3, term)
+    return term
+
+
+def memoize(capacity):
+    """Decorate a function so that its recent results are kept in an
+    LRUCache (the arguments must be hashable and the results immutable)
+    @param capacity The number of results to keep
+    """
+    def decorator(f):
+        cache = LRUCache(capacity)
+        missing = object()
+
+        @wraps(f)
+        def memoized(*args):
+            value = cache.get(args, missing)
+            if value is missing:
+                value = f(*args)
+                cache.put(args, value)
+            return value
+        memoized.cache = cache
+        return memoized
+    return decorator
@@ -1,6 +1,7 @@
 from rdflib import Graph, Literal, URIRef
 from rdflib.namespace import Namespace
 from yuzu.backend import RDFBackend
+from yuzu.cache import from_n3
 from yuzu.settings import (DB_FILE, METADATA_PATH, DISPLAY_NAME, LANG,
                            BASE_NAME, LIST_PATH, ONTOLOGY, ISSUE_DATE,
                            VERSION_INFO, DESCRIPTION, LICENSE, KEYWORDS,
@@ -11,10 +12,15 @@ from yuzu.settings import (DB_FILE, METADATA_PATH, DISPLAY_NAME, LANG,
 from rdflib.namespace import RDF, RDFS, XSD, DC, DCTERMS
 
 
-def dataid():
+def dataid(backend=None):
+    """Build the DataID (and VoID) description of the dataset
+    @param backend The backend to describe (by default the one at DB_FILE)
+    @return The description as an RDFlib Graph
+    """
     g = Graph()
 
-    backend = RDFBackend(DB_FILE)
+    if backend is None:
+        backend = RDFBackend(DB_FILE)
 
     BASE = Namespace(BASE_NAME)
     DCAT = Namespace("http://www.w3.org/ns/dcat#")
@@ -97,12 +103,40 @@ def dataid():
 
     g.add((dump, DCAT.downloadURL, URIRef(BASE[DUMP_URI[1:]])))
 
-    g.add((dataid, VOID.triples, Literal(str(backend.triple_count()),
+    triples = backend.triple_count()
+
+    g.add((dataid, VOID.triples, Literal(str(triples),
                                          datatype=XSD.integer)))
 
-    g.add((dump, VOID.triples, Literal(str(backend.triple_count()),
+    g.add((dump, VOID.triples, Literal(str(triples),
                                        datatype=XSD.integer)))
 
+    for stat, prop in [("subjects", VOID.distinctSubjects),
+                       ("pages", VOID.documents),
+                       ("properties", VOID.properties),
+                       ("classes", VOID.classes)]:
+        value = backend.stat(stat)
+        if value is not None:
+            g.add((dataid, prop, Literal(str(value), datatype=XSD.integer)))
+
+    i = 0
+    for prop, count in backend.stat_partitions("property"):
+        partition = BASE[METADATA_PATH + "#Property-" + str(i + 1)]
+        g.add((dataid, VOID.propertyPartition, partition))
+        g.add((partition, VOID.property, from_n3(prop)))
+        g.add((partition, VOID.triples, Literal(str(count),
+               datatype=XSD.integer)))
+        i += 1
+
+    i = 0
+    for cls, count in backend.stat_partitions("class"):
+        partition = BASE[METADATA_PATH + "#Class-" + str(i + 1)]
+        g.add((dataid, VOID.classPartition, partition))
+        g.add((partition, VOID["class"], from_n3(cls)))
+        g.add((partition, VOID.entities, Literal(str(count),
+               datatype=XSD.integer)))
+        i += 1
+
     g.add((dump, DC["format"], Literal("application/x-gzip")))
 
     if SPARQL_ENDPOINT:
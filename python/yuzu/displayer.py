@@ -1,6 +1,7 @@
 from rdflib.term import Literal, URIRef
 from rdflib.namespace import RDF, RDFS, XSD, OWL, DC, DCTERMS
 import re
+from yuzu.cache import memoize
 from yuzu.settings import (PREFIX1_QN, PREFIX1_URI, DATAID,
                            PREFIX2_QN, PREFIX2_URI, DCAT,
                            PREFIX3_QN, PREFIX3_URI, FOAF,
@@ -14,6 +15,7 @@ from yuzu.settings import (PREFIX1_QN, PREFIX1_URI, DATAID,
 
 # Displayers are here due to circular importing :(
 class DefaultDisplayer:
+    @memoize(10000)
     def uri_to_str(self, uri):
         if uri in PROP_NAMES:
             return PROP_NAMES[uri]
@@ -87,6 +89,7 @@ class PrettyDisplayer:
         else:
             ""
 
+    @memoize(10000)
     def uri_to_str(self, uri):
         if uri in PROP_NAMES:
             return PROP_NAMES[uri]
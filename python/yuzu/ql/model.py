@@ -1,11 +1,13 @@
+import json
 import sys
+from xml.sax.saxutils import escape
 if sys.version_info[0] < 3:
     from urllib2 import urlopen, HTTPError
 else:
     from urllib.request import urlopen
     from urllib.error import HTTPError
 from rdflib import URIRef, BNode
-from rdflib.util import from_n3
+from yuzu.cache import from_n3
 
 
 class FullURI:
@@ -250,6 +252,10 @@ class SelectQuery:
                            self.limit, self.offset)
 
 
+# The id column of the triples view for each term
+ID_COLUMNS = {"subject": "sid", "property": "pid", "object": "oid"}
+
+
 class Condition:
     def __init__(self, table, column, value):
         self.table = table
@@ -257,6 +263,10 @@ class Condition:
         self.value = value
 
     def build(self, qb):
+        if qb.term_sql:
+            return "%s.%s=%s" % (
+                qb.name_table(self.table), ID_COLUMNS[self.column],
+                qb.term_sql(self.value))
         return "%s.%s=\"%s\"" % (
             qb.name_table(self.table), self.column,
             self.value.replace("\"", "\"\""))
@@ -270,6 +280,10 @@ class EqualCondition:
         self.column2 = column2
 
     def build(self, qb):
+        if qb.term_sql:
+            return "%s.%s=%s.%s" % (
+                qb.name_table(self.table1), ID_COLUMNS[self.column1],
+                qb.name_table(self.table2), ID_COLUMNS[self.column2])
         return "%s.%s=%s.%s" % (
             qb.name_table(self.table1), self.column1,
             qb.name_table(self.table2), self.column2)
@@ -323,23 +337,27 @@ def srtsx_head(vars):
 
 
 def srtsx_body2(r, vars):
-    for v in vars:
-        val = from_n3(r[vars.index(v)])
+    for i, v in enumerate(vars):
+        if r[i] is None:
+            continue
+        val = from_n3(r[i])
         if isinstance(val, URIRef):
             yield ("    <binding name=\"%s\"><uri>%s</uri></binding>"
-                   % (v, str(val)))
+                   % (v, escape(str(val))))
         elif isinstance(val, BNode):
             yield ("    <binding name=\"%s\"><bnode>%s</bnode></binding>"
-                   % (v, str(val)))
+                   % (v, escape(str(val))))
         elif val.language:
             yield ("    <binding name=\"%s\"><literal xml:lang=\"%s\">"
-                   "%s</literal></binding>" % (v, val.language, str(val)))
+                   "%s</literal></binding>" % (v, val.language,
+                                               escape(str(val))))
         elif val.datatype:
             yield("     <binding name=\"%s\"><literal datatype=\"%s\">"
-                  "%s</literal></binding>" % (v, val.datatype, str(val)))
+                  "%s</literal></binding>" % (v, val.datatype,
+                                              escape(str(val))))
         else:
             yield("     <binding name=\"%s\"><literal>%s</literal></binding>"
-                  % (v, str(val)))
+                  % (v, escape(str(val))))
 
 
 def srtsx_body(result, vars):
@@ -350,16 +368,22 @@ def srtsx_body(result, vars):
 
 
 def sql_results_to_sparql_xml(results, vars):
-    return """<?xml version="1.0"?>
+    """Serialize SQL results as SPARQL XML results
+    @param results An iterable of result rows (as N3)
+    @param vars The names of the variables in each row
+    @return A generator of strings, one per result after the header
+    """
+    yield """<?xml version="1.0"?>
 <sparql xmlns="http://www.w3.org/2005/sparql-results#">
   <head>
 %s
   </head>
-  <results>
-%s
+  <results>""" % "\n".join(srtsx_head(vars))
+    for result in srtsx_body(results, vars):
+        yield "\n" + result
+    yield """
   </results>
-</sparql>""" % ("\n".join(srtsx_head(vars)),
-                "\n".join(srtsx_body(results, vars)))
+</sparql>"""
 
 
 def srtsj_head(vars):
@@ -368,50 +392,69 @@ def srtsj_head(vars):
 
 
 def srtsj_body2(r, vars):
-    for v in vars:
-        val = from_n3(r[vars.index(v)])
-        if not val:
-            yield ""
+    for i, v in enumerate(vars):
+        if r[i] is None:
+            continue
+        val = from_n3(r[i])
         if isinstance(val, URIRef):
-            yield ("      \"%s\": { \"type\": \"uri\", \"value\": \"%s\" }"
-                   % (v, str(val)))
+            yield ("        \"%s\": { \"type\": \"uri\", \"value\": %s }"
+                   % (v, json.dumps(str(val))))
         elif isinstance(val, BNode):
-            yield ("      \"%s\": { \"type\": \"bnode\", \"value\": \"%s\" }"
-                   % (v, str(val)))
+            yield ("        \"%s\": { \"type\": \"bnode\", \"value\": %s }"
+                   % (v, json.dumps(str(val))))
         elif val.language:
-            yield ("      \"%s\": { \"type\": \"literal\", \"xml:lang\": "
-                   "\"%s\", \"value\": \"%s\" }" % (v, val.language, str(val)))
+            yield ("        \"%s\": { \"type\": \"literal\", \"xml:lang\": "
+                   "\"%s\", \"value\": %s }" % (v, val.language,
+                                                json.dumps(str(val))))
         elif val.datatype:
-            yield ("      \"%s\": { \"type\": \"literal\", \"datatype\": "
-                   "\"%s\", \"value\": \"%s\" }" % (v, val.datatype,
-                                                    str(val)))
+            yield ("        \"%s\": { \"type\": \"literal\", \"datatype\": "
+                   "\"%s\", \"value\": %s }" % (v, val.datatype,
+                                                json.dumps(str(val))))
         else:
-            yield ("      \"%s\": { \"type\": \"literal\", \"value\": \"%s\" }"
-                   % (v, str(val)))
+            yield ("        \"%s\": { \"type\": \"literal\", \"value\": %s }"
+                   % (v, json.dumps(str(val))))
 
 
 def srtsj_body(result, vars):
-    return """    {
+    for r in result:
+        yield """      {
 %s
-    }""" % (",\n".join("x".join(srtsj_body2(r, vars))
-                       for r in result))
+      }""" % (",\n".join(srtsj_body2(r, vars)))
 
 
 def sql_results_to_sparql_json(results, vars):
-    return """{
+    """Serialize SQL results as SPARQL JSON results
+    @param results An iterable of result rows (as N3)
+    @param vars The names of the variables in each row
+    @return A generator of strings, one per result after the header
+    """
+    yield """{
   "head": { "vars": [ %s ] },
   "results": {
-    "bindings": [
-%s
+    "bindings": [""" % ", ".join(srtsj_head(vars))
+    separator = "\n"
+    for result in srtsj_body(results, vars):
+        yield separator + result
+        separator = ",\n"
+    yield """
     ]
   }
-}""" % (", ".join(srtsj_head(vars)),
-        srtsj_body(results, vars))
+}"""
 
 
 class QueryBuilder:
-    def __init__(self, select):
+    def __init__(self, select, term_sql=None, copies=True):
+        """Create a builder
+        @param select The query
+        @param term_sql A function giving the SQL for the id of a term (from
+        its N3), so that terms are compared by id. If None, terms are
+        compared by their N3
+        @param copies If false, the extra copies of the triples of blank
+        nodes that are stored under several pages (head=2) are skipped
+        """
         self.select = select
+        self.term_sql = term_sql
+        self.copies = copies
         self.var2col = {}
         self.tables = [Table()]
         self.joins = []
@@ -477,14 +520,18 @@ class QueryBuilder:
             cols = "COUNT(*), " + ", ".join(vs)
             group_by = " GROUP BY " + ", ".join(vs)
 
-        joins = [" %sJOIN triples AS %s ON %s.%s=%s.%s" % (
+        joins = [" %sJOIN triples AS %s ON %s.%s=%s.%s%s" % (
             j.left_join, self.name_table(j.table2), self.name_table(j.table1),
-            j.column1, self.name_table(j.table2), j.column2)
+            j.column1, self.name_table(j.table2), j.column2,
+            "" if self.copies else
+            " AND %s.head<2" % self.name_table(j.table2))
             for j in self.joins]
 
         join_str = "".join(joins)
 
         conds = conditions.build(self)
+        if not self.copies:
+            conds = " AND ".join(c for c in ["table0.head<2", conds] if c)
 
         if self.select.order_vars:
             ovs = " ORDER BY " + ", ".join(
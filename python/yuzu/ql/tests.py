@@ -56,6 +56,31 @@ class TestYuzuQL(unittest.TestCase):
                         "AND table1.property=\"<bar>\" "
                         "AND table0.object=table1.object")
 
+    def test_term_ids(self):
+        select = self.syntax.parse(
+            "select ?s { ?s <foo> ?o ; <bar> ?o }", {})
+        qb = QueryBuilder(select, lambda n3: "ID(%s)" % n3)
+        self.assertEqual("SELECT table1.subject "
+                         "FROM triples AS table0 "
+                         "JOIN triples AS table1 "
+                         "ON table0.sid=table1.sid "
+                         "WHERE table0.pid=ID(<foo>) "
+                         "AND table1.pid=ID(<bar>) "
+                         "AND table0.oid=table1.oid", qb.build())
+
+    def test_no_copies(self):
+        select = self.syntax.parse(
+            "select ?s { ?s <foo> ?o ; <bar> ?o }", {})
+        qb = QueryBuilder(select, copies=False)
+        self.assertEqual("SELECT table1.subject "
+                         "FROM triples AS table0 "
+                         "JOIN triples AS table1 "
+                         "ON table0.sid=table1.sid AND table1.head<2 "
+                         "WHERE table0.head<2 "
+                         "AND table0.property=\"<foo>\" "
+                         "AND table1.property=\"<bar>\" "
+                         "AND table0.object=table1.object", qb.build())
+
     def test_typed_literal(self):
         self.check_good("select * { ?s <foo> \"bar\"^^<baz> }",
                         "SELECT table0.subject FROM triples AS table0 "
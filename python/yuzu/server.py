@@ -1,6 +1,7 @@
 import re
 import os
 import sys
+import threading
 sys.path.append(os.path.dirname(__file__))
 import lxml.etree as et
 from wsgiref.simple_server import make_server
@@ -20,6 +21,7 @@ from copy import copy
 
 from yuzu.model import from_model, sparql_results_to_dict
 from yuzu.backend import RDFBackend
+from yuzu.cache import LRUCache
 from yuzu.displayer import DISPLAYER
 from yuzu.settings import (BASE_NAME, CONTEXT, PREFIX1_URI, PREFIX1_QN,
                            PREFIX2_URI, PREFIX2_QN, PREFIX3_URI, PREFIX3_QN,
@@ -29,7 +31,8 @@ from yuzu.settings import (BASE_NAME, CONTEXT, PREFIX1_URI, PREFIX1_QN,
                            DISPLAY_NAME, FACETS, SEARCH_PATH,
                            DUMP_URI, DUMP_FILE, ASSETS_PATH, SPARQL_PATH,
                            LIST_PATH, DB_FILE, METADATA_PATH, DCAT,
-                           FOAF, ODRL, PROV, VOID, DATAID)
+                           FOAF, ODRL, PROV, VOID, DATAID, TEMPLATE_RELOAD,
+                           RESPONSE_CACHE_SIZE, STREAM_CHUNK_SIZE)
 from yuzu.user_text import (YZ_NO_QUERY, YZ_TIME_OUT, YZ_MOVED_TO,
                             YZ_INVALID_QUERY, YZ_BAD_REQUEST,
                             YZ_NOT_FOUND_TITLE, YZ_NOT_FOUND_PAGE,
@@ -50,6 +53,153 @@ def resolve(fname):
         return "/common/" + fname
 
 
+def encode_chunks(content, size=STREAM_CHUNK_SIZE):
+    """Encode a response body for WSGI as it is generated, grouping small
+    pieces together so that the server does not write every line separately
+    @param content A string or an iterable of strings
+    @param size The minimum size of each chunk (except the last) in bytes
+    @return A generator of byte strings
+    """
+    if isinstance(content, (bytes, type(u""))):
+        content = [content]
+    chunk = []
+    length = 0
+    for piece in content:
+        if not isinstance(piece, bytes):
+            piece = piece.encode('utf-8')
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+class TemplateRegistry:
+    """Loads and parses the templates under common/html once and keeps them
+    in memory"""
+    def __init__(self, reload=TEMPLATE_RELOAD):
+        """Create a registry
+        @param reload If true check the modification time of templates on
+        every use and reload them if they have changed
+        """
+        self.reload = reload
+        self.sources = {}
+        self.parsed = {}
+        self.lock = threading.Lock()
+
+    def source(self, name):
+        """Get the text of a template
+        @param name The file name of the template (relative to html/)
+        @return The template as a string
+        """
+        entry = self.sources.get(name)
+        if entry is None or self.reload:
+            path = resolve("html/" + name)
+            mtime = os.stat(path).st_mtime
+            if entry is None or entry[0] != mtime:
+                with open(path) as f:
+                    entry = (mtime, f.read())
+                with self.lock:
+                    self.sources[name] = entry
+        return entry[1]
+
+    def parse(self, template, delimiters=None):
+        """Parse a template, reusing the result of any previous parse of the
+        same text
+        @param template The template text
+        @param delimiters The delimiters (as given by pystache)
+        @return A pystache ParsedTemplate
+        """
+        key = (template, delimiters)
+        parsed = self.parsed.get(key)
+        if parsed is None:
+            parsed = pystache.parse(template, delimiters)
+            with self.lock:
+                if len(self.parsed) >= 1000:
+                    self.parsed.clear()
+                self.parsed[key] = parsed
+        return parsed
+
+    def get(self, name):
+        """Get a partial by name (as required by pystache)"""
+        return self.source(name + ".mustache")
+
+    def render(self, name, context):
+        """Render a template
+        @param name The file name of the template (relative to html/)
+        @param context The values to render the template with
+        @return The rendered string
+        """
+        if CACHED_PARTIALS:
+            renderer = CachedRenderer(self)
+        else:
+            renderer = pystache.Renderer(partials=self)
+        return renderer.render(self.parse(self.source(name)), context)
+
+
+# CachedRenderer overrides the internals of pystache, so it is only used with
+# the version it was written against (0.6). Other versions parse the partials
+# again on every inclusion, which is slower but only uses the public API
+CACHED_PARTIALS = getattr(pystache, "__version__", "").startswith("0.6.")
+
+
+class CachedRenderer(pystache.Renderer):
+    """A renderer that takes partials from a template registry and does not
+    parse them again on every inclusion (see CACHED_PARTIALS)"""
+    def __init__(self, registry):
+        pystache.Renderer.__init__(self, partials=registry)
+        self.registry = registry
+
+    def _make_render_engine(self):
+        engine = pystache.Renderer._make_render_engine(self)
+        registry = self.registry
+
+        def render(template, context_stack, delimiters=None):
+            return registry.parse(template, delimiters).render(
+                engine, context_stack)
+        engine.render = render
+        return engine
+
+
+# The templates used by the server
+TEMPLATES = TemplateRegistry()
+
+
+class ResponseCache:
+    """Keeps rendered resource pages in memory for the current generation of
+    the database"""
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        """Create a cache
+        @param size The maximum number of bytes of pages to keep
+        """
+        self.pages = LRUCache(size, sizeof=lambda key, page: len(page))
+        self.generation = None
+
+    def get(self, key, generation):
+        """Get a page, discarding all pages if the database has changed
+        @param key The key of the page
+        @param generation The current generation of the database
+        @return The page as bytes or None if it is not cached
+        """
+        if generation != self.generation:
+            self.pages.clear()
+            self.generation = generation
+            return None
+        return self.pages.get(key)
+
+    def put(self, key, generation, page):
+        """Add a page to the cache
+        @param key The key of the page
+        @param generation The generation the page was rendered from
+        @param page The page as bytes
+        """
+        if generation is not None and generation == self.generation:
+            self.pages.put(key, page)
+
+
 class RDFServer:
     """The main web server class for Yuzu"""
     def __init__(self, db):
@@ -63,6 +213,9 @@ class RDFServer:
              ('sparql', 'application/sparql-results+xml'),
              ('sparql-json', 'application/sparql-results+json')])
         self.backend = RDFBackend(db)
+        self.cache = ResponseCache()
+        # The metadata is kept apart so that it is not evicted by pages
+        self.metadata = ResponseCache()
 
     @staticmethod
     def render_html(title, text, is_test=False):
@@ -71,11 +224,11 @@ class RDFServer:
         @param title The page title (in the header)
         @param text The page content
         """
-        template = open(resolve("html/page.mustache")).read()
-        return pystache.render(template, {'title': title, 'content': text,
-                                          'app_title': DISPLAY_NAME,
-                                          'context': CONTEXT,
-                                          'is_test': is_test})
+        return TEMPLATES.render("page.mustache",
+                                {'title': title, 'content': text,
+                                 'app_title': DISPLAY_NAME,
+                                 'context': CONTEXT,
+                                 'is_test': is_test})
 
     @staticmethod
     def send302(start_response, location):
@@ -86,6 +239,16 @@ class RDFServer:
         start_response('302 Found', [('Location', location)])
         return [YZ_MOVED_TO + location]
 
+    @staticmethod
+    def send304(start_response, etag):
+        """Send a 304 not modified
+        @param start_response The response object
+        @param etag The entity tag of the unchanged resource
+        """
+        start_response('304 Not Modified', [('ETag', etag),
+                                            ('Vary', 'Accept')])
+        return []
+
     @staticmethod
     def send400(start_response, message=YZ_INVALID_QUERY):
         """Send a 400 bad request
@@ -118,6 +281,25 @@ class RDFServer:
         return [RDFServer.render_html(YZ_NOT_IMPLEMENTED,
                                       message).encode('utf-8')]
 
+    @staticmethod
+    def etag_matches(environ, etag, exists=False):
+        """Check if the client already has the current version of a resource
+        @param environ The WSGI environment
+        @param etag The current entity tag of the resource
+        @param exists If the resource is known to exist, in which case * also
+        matches
+        @return True if the If-None-Match header matches the tag
+        """
+        if 'HTTP_IF_NONE_MATCH' not in environ:
+            return False
+        for tag in environ['HTTP_IF_NONE_MATCH'].split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag or (exists and tag == "*"):
+                return True
+        return False
+
     @staticmethod
     def best_mime_type(accept_string, default):
         """Guess the MIME type from the Accept string
@@ -194,7 +376,7 @@ class RDFServer:
         if timed_out:
             start_response('503 Service Unavailable', [('Content-type',
                                                         'text/plain')])
-            return YZ_TIME_OUT
+            return encode_chunks(YZ_TIME_OUT)
         else:
             # This doesn't take into account describe queries!!!
             if result_type == "error":
@@ -202,15 +384,14 @@ class RDFServer:
             if mime_type == "html":
                 start_response('200 OK', [('Content-type',
                                            'text/html; charset=utf-8')])
-                dom = et.fromstring(result)
+                dom = et.fromstringlist(encode_chunks(result))
                 if dom.tag == '{http://www.w3.org/2005/sparql-results#}sparql':
-                    content = pystache.render(
-                        open(resolve("html/sparql-results.mustache")).read(),
-                        sparql_results_to_dict(dom))
+                    content = TEMPLATES.render("sparql-results.mustache",
+                                               sparql_results_to_dict(dom))
 
                 else:
                     g = Graph()
-                    g.parse(data=result)
+                    g.parse(data=et.tostring(dom), format="xml")
                     content = self.rdfxml_to_html(g, None, False)
                 result = self.render_html("SPARQL Results", content)
                 return [result.encode('utf-8')]
@@ -218,7 +399,7 @@ class RDFServer:
             else:
                 start_response('200 OK', [('Content-type',
                                            self.mime_types[result_type])])
-                return [result.encode('utf-8')]
+                return encode_chunks(result)
 
     def add_namespaces(self, graph):
         graph.namespace_manager.bind("ontology", BASE_NAME+"ontology#")
@@ -241,20 +422,38 @@ class RDFServer:
         graph.namespace_manager.bind("prov", PROV)
         graph.namespace_manager.bind("void", VOID)
 
+    def serialize(self, graph, mime, uri):
+        """Serialize a graph in one of the RDF formats
+        @param graph The graph
+        @param mime The format (one of the keys of mime_types)
+        @param uri The URI of the document
+        @return The serialization as a string
+        """
+        self.add_namespaces(graph)
+        if mime == "json-ld":
+            return yuzu.jsonld.write(graph, uri)
+        content = graph.serialize(format=mime)
+        # Older versions of RDFlib return bytes
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return content
+
     def rdfxml_to_html(self, graph, query, title="", is_test=False):
         """Convert RDF data to XML
         @param graph The RDFlib graph object
         @param title The page header to show (optional)
         """
         elem = from_model(graph, query)
-        renderer = pystache.Renderer(search_dirs=resolve("html/"))
-        data_html = renderer.render_name("rdf2html", elem)
+        data_html = TEMPLATES.render("rdf2html.mustache", elem)
         return self.render_html(title, data_html, is_test)
 
     def application(self, environ, start_response):
         """The entry point for all queries (see WSGI docs for more details)"""
         uri = environ['PATH_INFO'].encode('latin-1').decode()
         is_test = request_uri(environ) == BASE_NAME + uri
+        # Checked once per request, so that every route moves to a new
+        # database as soon as it has been swapped in by a load
+        generation = self.backend.generation()
 
         # Guess the file type required
         if re.match(".*\.html", uri):
@@ -282,13 +481,13 @@ class RDFServer:
             start_response('200 OK', [('Content-type',
                                        'text/html; charset=utf-8')])
             if not exists(DB_FILE):
-                return [self.render_html(DISPLAY_NAME, pystache.render(
-                    open(resolve("html/onboarding.mustache")).read(),
+                return [self.render_html(DISPLAY_NAME, TEMPLATES.render(
+                    "onboarding.mustache",
                     {'context': CONTEXT}), is_test)]
             else:
                 return [self.render_html(
                     DISPLAY_NAME,
-                    pystache.render(open(resolve("html/index.html")).read(),
+                    TEMPLATES.render("index.html",
                         {'property_facets': FACETS, 'context': CONTEXT}),
                     is_test).encode('utf-8')]
         # The search page
@@ -306,7 +505,12 @@ class RDFServer:
                         offset = int(qs_parsed['offset'][0])
                     else:
                         offset = 0
-                    return self.search(start_response, query, prop, offset)
+                    if 'after' in qs_parsed:
+                        after = qs_parsed['after'][0]
+                    else:
+                        after = None
+                    return self.search(start_response, query, prop, offset,
+                                       after)
                 else:
                     return self.send400(start_response, YZ_NO_RESULTS)
             else:
@@ -347,14 +551,14 @@ class RDFServer:
                 else:
                     start_response('200 OK', [('Content-type',
                                                'text/html; charset=utf-8')])
-                    s = open(resolve("html/sparql.html")).read()
+                    s = TEMPLATES.source("sparql.html")
                     return [self.render_html(
                         DISPLAY_NAME,
                         s, is_test).encode('utf-8')]
             else:
                 start_response('200 OK', [('Content-type',
                                            'text/html; charset=utf-8')])
-                s = open(resolve("html/sparql.html")).read()
+                s = TEMPLATES.source("sparql.html")
                 return [self.render_html(DISPLAY_NAME, s,
                                          is_test).encode('utf-8')]
         elif LIST_PATH and (uri == LIST_PATH or uri == (LIST_PATH + "/")):
@@ -362,6 +566,8 @@ class RDFServer:
             prop = None
             obj = None
             obj_offset = 0
+            after = None
+            obj_after = None
             if 'QUERY_STRING' in environ:
                 qs = parse_qs(environ['QUERY_STRING'])
                 if 'offset' in qs:
@@ -375,9 +581,14 @@ class RDFServer:
                     obj = qs['obj'][0]
                 if 'obj_offset' in qs and re.match("\d+", qs['obj_offset'][0]):
                     obj_offset = int(qs['obj_offset'][0])
+                if 'after' in qs:
+                    after = qs['after'][0]
+                if 'obj_after' in qs:
+                    obj_after = qs['obj_after'][0]
 
             return self.list_resources(start_response, offset,
-                                       prop, obj, obj_offset)
+                                       prop, obj, obj_offset, after,
+                                       obj_after)
         elif METADATA_PATH and (uri == METADATA_PATH or
                                 uri == ("/" + METADATA_PATH) or
                                 uri == ("/" + METADATA_PATH + ".rdf") or
@@ -388,31 +599,39 @@ class RDFServer:
                                 uri == (METADATA_PATH + ".nt") or
                                 uri == ("/" + METADATA_PATH + ".json") or
                                 uri == (METADATA_PATH + ".json")):
-            graph = dataid()
-            if mime == "html":
-                content = self.rdfxml_to_html(graph, BASE_NAME + METADATA_PATH,
-                                              YZ_METADATA, is_test)
-            else:
-                try:
-                    self.add_namespaces(graph)
-                    if mime == "json-ld":
-                        content = yuzu.jsonld.write(
-                            graph, BASE_NAME + id)
-                    else:
-                        content = graph.serialize(format=mime).decode('utf-8')
-                except Exception as e:
-                    print (e)
-                    return self.send501(start_response)
+            etag = '"%s-%s%s"' % (generation, mime, "-test" if is_test else "")
+            if self.etag_matches(environ, etag):
+                return self.send304(start_response, etag)
+            key = (mime, is_test)
+            content = self.metadata.get(key, generation)
+            if content is None:
+                graph = dataid(self.backend)
+                if mime == "html":
+                    content = self.rdfxml_to_html(
+                        graph, BASE_NAME + METADATA_PATH, YZ_METADATA,
+                        is_test)
+                else:
+                    try:
+                        content = self.serialize(
+                            graph, mime, BASE_NAME + METADATA_PATH)
+                    except Exception as e:
+                        print (e)
+                        return self.send501(start_response)
+                content = content.encode('utf-8')
+                self.metadata.put(key, generation, content)
+            if self.etag_matches(environ, etag, exists=True):
+                return self.send304(start_response, etag)
             start_response(
                 '200 OK',
                 [('Content-type', self.mime_types[mime] + "; charset=utf-8"),
-                 ('Vary', 'Accept'), ('Content-length', str(len(content)))])
-            return [content.encode('utf-8')]
+                 ('Vary', 'Accept'), ('ETag', etag),
+                 ('Content-length', str(len(content)))])
+            return [content]
         elif exists(resolve("html/%s.html" % re.sub("/$", "", uri))):
             start_response('200 OK', [('Content-type',
                                        'text/html; charset=utf-8')])
-            s = pystache.render(open(resolve(
-                "html/%s.html" % re.sub("/$", "", uri))).read(),
+            s = TEMPLATES.render(
+                "%s.html" % re.sub("/$", "", uri),
                 {'context': CONTEXT,
                  'dump_uri': DUMP_URI})
             return [self.render_html(DISPLAY_NAME, s,
@@ -421,47 +640,61 @@ class RDFServer:
         elif re.match("^/(.*?)(|\.nt|\.html|\.rdf|\.ttl|\.json)$", uri):
             id, _ = re.findall(
                 "^/(.*?)(|\.nt|\.html|\.rdf|\.ttl|\.json)$", uri)[0]
-            graph = self.backend.lookup(id)
-            if graph is None:
-                return self.send404(start_response)
-            labels = sorted([str(o) for s, p, o in
-                             graph.triples(
-                                 (URIRef(BASE_NAME + id), RDFS.label, None))])
-            if labels:
-                title = ', '.join(labels)
-            else:
-                title = DISPLAYER.uri_to_str(BASE_NAME + id)
-            if mime == "html":
-                content = self.rdfxml_to_html(graph, BASE_NAME + id, title,
-                                              is_test)
-            else:
-                try:
-                    self.add_namespaces(graph)
-                    if mime == "json-ld":
-                        content = yuzu.jsonld.write(
-                            graph, BASE_NAME + id)
-                    else:
-                        content = graph.serialize(format=mime).decode('utf-8')
-                except Exception as e:
-                    print (e)
-                    return self.send501(start_response)
+            etag = '"%s-%s%s"' % (generation, mime, "-test" if is_test else "")
+            if self.etag_matches(environ, etag):
+                return self.send304(start_response, etag)
+            key = (id, mime, is_test)
+            content = self.cache.get(key, generation)
+            if content is None:
+                graph = self.backend.lookup(id)
+                if graph is None:
+                    return self.send404(start_response)
+                if self.etag_matches(environ, etag, exists=True):
+                    return self.send304(start_response, etag)
+                labels = sorted([str(o) for s, p, o in
+                                 graph.triples(
+                                     (URIRef(BASE_NAME + id), RDFS.label,
+                                      None))])
+                if labels:
+                    title = ', '.join(labels)
+                else:
+                    title = DISPLAYER.uri_to_str(BASE_NAME + id)
+                if mime == "html":
+                    content = self.rdfxml_to_html(graph, BASE_NAME + id,
+                                                  title, is_test)
+                else:
+                    try:
+                        content = self.serialize(graph, mime, BASE_NAME + id)
+                    except Exception as e:
+                        print (e)
+                        return self.send501(start_response)
+                content = content.encode('utf-8')
+                self.cache.put(key, generation, content)
+            elif self.etag_matches(environ, etag, exists=True):
+                return self.send304(start_response, etag)
             start_response(
                 '200 OK',
                 [('Content-type', self.mime_types[mime] + "; charset=utf-8"),
-                 ('Vary', 'Accept'), ('Content-length', str(len(content)))])
-            return [content.encode('utf-8')]
+                 ('Vary', 'Accept'), ('ETag', etag),
+                 ('Content-length', str(len(content)))])
+            return [content]
         else:
             return self.send404(start_response)
 
-    def list_resources(self, start_response, offset, prop, obj, obj_offset):
+    def list_resources(self, start_response, offset, prop, obj, obj_offset,
+                       after=None, obj_after=None):
         """Build the list resources page
         @param start_response The response object
         @param offset The offset to show from
+        @param after The continuation token of the page (if any)
+        @param obj_after The continuation token of the facet values (if any)
         """
         limit = 20
-        has_more, results = self.backend.list_resources(
-            offset, limit, prop, obj)
-        template = open(resolve("html/list.html")).read()
+        try:
+            has_more, results = self.backend.list_resources(
+                offset, limit, prop, obj, after)
+        except ValueError:
+            return self.send400(start_response)
         if offset > 0:
             has_prev = ""
         else:
@@ -472,6 +705,12 @@ class RDFServer:
         else:
             has_next = "disabled"
         nxt = offset + limit
+        # The next page continues from the last result, which (unlike the
+        # offset) does not get slower deeper into the list
+        if has_more and results:
+            nxt_after = "&after=" + quote_plus(results[-1]['token'])
+        else:
+            nxt_after = ""
         pages = "%d - %d" % (offset + 1, offset + min(limit, len(results)))
         facets = []
         for facet in FACETS:
@@ -481,16 +720,28 @@ class RDFServer:
                     facets.append(facet)
                 else:
                     facet = copy(facet)
-                    mv, val_results = self.backend.list_values(obj_offset, 20,
-                                                               prop)
+                    try:
+                        mv, val_results = self.backend.list_values(
+                            obj_offset, 20, prop, obj_after)
+                    except ValueError:
+                        return self.send400(start_response)
+                    if obj_after:
+                        values_after = "&obj_after=" + quote_plus(obj_after)
+                    else:
+                        values_after = ""
                     facet['values'] = [{
                         'prop_uri': facet['uri_enc'],
                         'value_enc': quote_plus(v['link']),
                         'value': v['label'][:100],
                         'count': v['count'],
-                        'offset': obj_offset} for v in val_results]
+                        'offset': obj_offset,
+                        'after': values_after} for v in val_results]
                     if mv:
                         facet['more_values'] = obj_offset + 20
+                        if val_results:
+                            facet['more_after'] = (
+                                "&obj_after=" +
+                                quote_plus(val_results[-1]['token']))
                     facets.append(facet)
 
         start_response(
@@ -501,34 +752,43 @@ class RDFServer:
         if obj:
             query += "&obj=" + quote_plus(obj)
         if obj_offset:
-            query += "&obj_offset=" + obj_offset
+            query += "&obj_offset=%d" % obj_offset
+        if obj_after:
+            query += "&obj_after=" + quote_plus(obj_after)
 
+        summaries = self.backend.summarize_many([r["id"] for r in results])
         results2 = [{
             "title": r["label"],
             "link": r["link"],
-            "model": from_model(
-                self.backend.summarize(r["id"]),
-                BASE_NAME + r["id"])}
+            "model": from_model(summaries[r["id"]], BASE_NAME + r["id"])}
             for r in results]
-        mres = pystache.render(template, {
+        mres = TEMPLATES.render("list.html", {
             'facets': facets,
             'results': results2,
             'has_prev': has_prev,
             'prev': prev,
             'has_next': has_next,
             'next': nxt,
+            'after': nxt_after,
             'pages': pages,
             'query': query,
             'context': CONTEXT})
         return [self.render_html(DISPLAY_NAME, mres).encode('utf-8')]
 
-    def search(self, start_response, query, prop, offset):
+    def search(self, start_response, query, prop, offset, after=None):
         limit = 20
+        try:
+            results = self.backend.search(query, prop, offset, limit, after)
+        except ValueError:
+            return self.send400(start_response)
         start_response(
             '200 OK', [('Content-type', 'text/html; charset=utf-8')])
-        results = self.backend.search(query, prop, offset, limit)
         prev = max(0, offset - limit)
         nxt = offset + limit
+        if len(results) > limit and results[limit - 1]['token']:
+            nxt_after = "&after=" + quote_plus(results[limit - 1]['token'])
+        else:
+            nxt_after = ""
         pages = "%d - %d" % (offset + 1, offset + min(limit, len(results)))
         if offset == 0:
             has_prev = " disabled"
@@ -540,21 +800,22 @@ class RDFServer:
             has_next = ""
         qs = "&query=" + quote_plus(query)
         if prop:
-            qs = "&property=" + quote_plus(prop)
+            qs += "&property=" + quote_plus(prop)
+        summaries = self.backend.summarize_many(
+            [r["id"] for r in results[:limit]])
         results2 = [{
             "title": r["label"],
             "link": r["link"],
-            "model": from_model(
-                self.backend.summarize(r["id"]),
-                BASE_NAME + r["id"])}
-            for r in results]
-        page = pystache.render(
-            open(resolve('html/search.html')).read(),
-            {'results': results2[:limit],
+            "model": from_model(summaries[r["id"]], BASE_NAME + r["id"])}
+            for r in results[:limit]]
+        page = TEMPLATES.render(
+            "search.html",
+            {'results': results2,
              'context': CONTEXT,
              'prev': prev,
              'has_prev': has_prev,
              'next': nxt,
+             'after': nxt_after,
              'has_next': has_next,
              'pages': pages,
              'query': qs})
@@ -581,10 +842,36 @@ class RDFServer:
         }
 
 
+_server = None
+_server_pid = None
+_server_lock = threading.Lock()
+
+
+def _reset_server_lock():
+    global _server_lock
+    _server_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_server_lock)
+
+
+def get_server():
+    """Get the server for this process. The server is created on first use
+    and created again in any child process after a fork, so that no
+    connections are shared between processes"""
+    global _server, _server_pid
+    if _server is None or _server_pid != os.getpid():
+        with _server_lock:
+            if _server is None or _server_pid != os.getpid():
+                _server = RDFServer(DB_FILE)
+                _server_pid = os.getpid()
+    return _server
+
+
 def application(environ, start_response):
     """Needed to start the app in mod_wsgi"""
-    server = RDFServer(DB_FILE)
-    return server.application(environ, start_response)
+    return get_server().application(environ, start_response)
 
 if __name__ == "__main__":
     opts = dict(getopt.getopt(sys.argv[1:], 'd:p:')[0])
@@ -14,8 +14,40 @@ DUMP_URI = "/example.nt.gz"
 DUMP_FILE = "../example.nt.gz"
 # Where the SQLite database should appear
 DB_FILE = "example.db"
+# The number of bytes of the database to memory map when serving (set to 0
+# to disable memory mapping, or None to map the whole file)
+SQLITE_MMAP_SIZE = None
+# Open the database as immutable when serving, which skips all locking and
+# change detection. The database must then only be changed by the loader
+# (which replaces the file instead of writing to it), so each change applied
+# with -a/-r copies the whole database, and takes time in proportion to the
+# database rather than to the change. If False, the changes are applied in
+# place
+SQLITE_IMMUTABLE = False
+# The size of the page cache of each serving connection (negative values are
+# in KiB, positive values are in pages)
+SQLITE_CACHE_SIZE = -65536
+# The size of the page cache used while loading and indexing the database
+SQLITE_LOAD_CACHE_SIZE = -524288
+# The approximate number of bytes of memory used to remember the ids of
+# terms while loading. Set to None to keep every term in memory, which is
+# fastest if there is enough memory for all the terms in the dump
+LOAD_CACHE_MEMORY = 268435456
+# Also store each page as one contiguous block (the page_triples table), so
+# that pages are read without joins. This makes the database larger
+PAGE_TABLE = False
 # The name of the server
 DISPLAY_NAME = "Example"
+# Reload templates when they are changed on disk (useful while developing,
+# but costs a stat call per template per request)
+TEMPLATE_RELOAD = False
+# The maximum number of bytes of rendered resource pages to keep in memory
+# (set to 0 to disable the cache)
+RESPONSE_CACHE_SIZE = 67108864
+# The number of parsed RDF terms (URIs, literals) to keep in memory
+TERM_CACHE_SIZE = 100000
+# The size (in bytes) of the chunks that large query results are streamed in
+STREAM_CHUNK_SIZE = 65536
 # The extra namespaces to be abbreviated in HTML and RDF/XML
 # documents if desired
 PREFIX1_URI = "http://www.example.com/"
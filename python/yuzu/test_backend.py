@@ -0,0 +1,582 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+
+import yuzu.backend
+from yuzu.backend import (RDFBackend, DeltaLoad, LoadCache,
+                          SCHEMA_VERSION, fts_query, split_n3, unicode_escape,
+                          unescape_literal)
+from yuzu.settings import BASE_NAME
+
+DUMP = ("<%(b)sdata/example> <http://www.w3.org/2000/01/rdf-schema#label> "
+        "\"Example\"@en .\n"
+        "<%(b)sdata/example> "
+        "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type> "
+        "<%(b)sontology#Thing> .\n"
+        "<%(b)sdata/example> <%(b)sontology#link> <%(b)sdata/other> .\n"
+        "<%(b)sdata/example> <%(b)sontology#sense> <%(b)sdata/example#s1> .\n"
+        "<%(b)sdata/example#s1> <%(b)sontology#gloss> _:g1 .\n"
+        "_:g1 <http://www.w3.org/2000/01/rdf-schema#label> \"A gloss\" .\n"
+        "_:g1 <%(b)sontology#note> _:g2 .\n"
+        "_:g2 <http://www.w3.org/2000/01/rdf-schema#label> \"A note\" .\n"
+        "<%(b)sdata/other> <http://www.w3.org/2000/01/rdf-schema#label> "
+        "\"Other\"@en .\n"
+        "<%(b)sdata/other> <http://www.w3.org/2000/01/rdf-schema#seeAlso> "
+        "<http://dbpedia.org/resource/Other> .\n") % {'b': BASE_NAME}
+
+
+def legacy_unicode_escape(s):
+    """The original (quadratic) implementation of unicode_escape"""
+    i = 0
+    while i < len(s):
+        if s[i:i+2] == "\\u":
+            if sys.version_info[0] < 3:
+                s = s[:i] + unichr(int(s[i+2:i+6], 16)) + s[i+6:]
+            else:
+                s = s[:i] + chr(int(s[i+2:i+6], 16)) + s[i+6:]
+        i += 1
+    return s
+
+
+class UnicodeEscapeTest(unittest.TestCase):
+
+    def random_term(self, rand):
+        pieces = []
+        for _ in range(rand.randint(0, 20)):
+            kind = rand.randint(0, 4)
+            if kind == 0:
+                pieces.append("\\u%04x" % rand.choice([
+                    rand.randint(0x20, 0xD7FF), rand.randint(0xE000, 0xFFFF)]))
+            elif kind == 1:
+                pieces.append("\\" + rand.choice("tnr\"'"))
+            elif kind == 2:
+                pieces.append(u"\u00e9\u4e2d")
+            else:
+                pieces.append("".join(rand.choice("abu\" <>#_:@0123456789")
+                                      for _ in range(rand.randint(1, 5))))
+        return "".join(pieces)
+
+    def test_matches_legacy(self):
+        rand = random.Random(1234)
+        for _ in range(2000):
+            term = self.random_term(rand)
+            self.assertEqual(legacy_unicode_escape(term),
+                             unicode_escape(term))
+
+    def test_long_escapes(self):
+        self.assertEqual(u"\U0001F600", unicode_escape("\\U0001F600"))
+        self.assertEqual(u"a\U0001F600b", unicode_escape("a\\ud83d\\ude00b"))
+
+    def test_other_escapes_kept(self):
+        self.assertEqual("\\\\u0041 \\n \\uZZZZ \\U00110000",
+                         unicode_escape("\\\\u0041 \\n \\uZZZZ \\U00110000"))
+
+    def test_unescape_literal(self):
+        self.assertEqual(u"a\"b\\c\td\u00e9",
+                         unescape_literal("a\\\"b\\\\c\\td\\u00E9"))
+
+
+class LoadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.cursor = self.conn.cursor()
+        RDFBackend.create_tables(self.cursor)
+
+    def test_evicted_terms_keep_ids(self):
+        cache = LoadCache(self.cursor, memory=2 * LoadCache.ENTRY_OVERHEAD)
+        first = cache.get_many(["<a>", "<b>", "<c>"])
+        self.assertEqual([1, 2, 3], [first[k] for k in ["<a>", "<b>", "<c>"]])
+        self.assertNotIn("<a>", cache.terms)
+        self.assertEqual({"<a>": 1, "<d>": 4}, cache.get_many(["<a>", "<d>"]))
+        self.assertEqual([(4,)],
+                         self.cursor.execute("select count(*) from ids")
+                         .fetchall())
+
+    def test_full_dictionary(self):
+        cache = LoadCache(self.cursor, memory=None)
+        self.assertTrue(cache.complete)
+        cache.get_many(["<a>", "<b>"])
+        self.assertEqual({"<b>": 2, "<c>": 3}, cache.get_many(["<b>", "<c>"]))
+        self.assertEqual(1, cache.terms.hits)
+
+    def test_existing_database(self):
+        LoadCache(self.cursor).get_many(["<a>"])
+        cache = LoadCache(self.cursor, memory=None)
+        self.assertFalse(cache.complete)
+        self.assertEqual({"<a>": 1, "<b>": 2}, cache.get_many(["<a>", "<b>"]))
+
+
+class BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "test.db")
+        self.backend = RDFBackend(self.db)
+        self.backend.load(BytesIO(DUMP.encode('utf-8')))
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.dir)
+
+    def query(self, sql, *args):
+        return self.backend.connection().execute(sql, args).fetchall()
+
+    def test_load_labels(self):
+        self.assertEqual([("Example",)], self.query(
+            "select label from ids where n3=?",
+            "<%sdata/example>" % BASE_NAME))
+
+    def test_load_escaped_label(self):
+        backend = RDFBackend(os.path.join(self.dir, "escaped.db"))
+        backend.load(BytesIO((
+            "<%sdata/caf\\u00E9> <http://www.w3.org/2000/01/rdf-schema#label> "
+            "\"Caf\\u00E9 \\\"Noir\\\"\"@fr .\n" % BASE_NAME).encode('utf-8')))
+        self.assertEqual([(u"Caf\u00e9 \"Noir\"",)],
+                         backend.connection().execute(
+                             "select label from ids where n3=?",
+                             (u"<%sdata/caf\u00e9>" % BASE_NAME,)).fetchall())
+        backend.close()
+
+    def test_load_ids(self):
+        self.assertEqual([(0,)], self.query(
+            """select count(*) from tripids where sid not in (select id from
+            ids) or pid not in (select id from ids) or oid not in (select id
+            from ids)"""))
+        self.assertEqual(self.query("select count(*) from ids"),
+                         self.query("select count(distinct n3) from ids"))
+
+    def test_load_terms(self):
+        self.assertEqual([("example>", "Example")], self.query(
+            """select local, label from terms join prefixes
+               on terms.prefix=prefixes.id where prefixes.prefix=?""",
+            "<%sdata/" % BASE_NAME)[:1])
+        self.assertEqual([("<%sdata/example>" % BASE_NAME,)], self.query(
+            "select main from ids where n3=?",
+            "<%sdata/example#s1>" % BASE_NAME))
+
+    def test_split_n3(self):
+        self.assertEqual(("<http://a/b#", "c>"), split_n3("<http://a/b#c>"))
+        self.assertEqual(("<http://a/", "b>"), split_n3("<http://a/b>"))
+        self.assertEqual(("", "<urn:a>"), split_n3("<urn:a>"))
+        self.assertEqual(("", "\"a/b\"@en"), split_n3("\"a/b\"@en"))
+
+    def test_version_1(self):
+        label = "<http://www.w3.org/2000/01/rdf-schema#label>"
+        other = "\"Other\"@en"
+        expected = (self.backend.list_resources(0, 10, label, other),
+                    self.backend.list_values(0, 10, label))
+        conn = sqlite3.connect(self.db)
+        conn.execute("""create table old_ids as
+                        select id, n3, main, label from ids""")
+        conn.execute("drop view ids")
+        conn.execute("create table ids as select * from old_ids")
+        conn.execute("create unique index n3s on ids(n3)")
+        conn.execute("PRAGMA user_version=1")
+        conn.commit()
+        conn.close()
+        backend = RDFBackend(self.db)
+        self.assertEqual(1, backend.pool.version())
+        self.assertEqual(expected,
+                         (backend.list_resources(0, 10, label, other),
+                          backend.list_values(0, 10, label)))
+        self.assertEqual(["data/other"], [r['id'] for r in backend.search(
+            "Other", "http://www.w3.org/2000/01/rdf-schema#label", 0)])
+        backend.close()
+
+    def test_load_links(self):
+        self.assertEqual([(1, "http://dbpedia.org/")],
+                         self.query("select count, target from links"))
+
+    def test_load_indexes(self):
+        indexes = set(name for name, in self.query(
+            "select name from sqlite_master where type='index'"))
+        for name, _, _ in RDFBackend.INDEXES:
+            self.assertIn(name, indexes)
+
+    def test_load_blank_nodes(self):
+        self.assertEqual([("data/example",)], self.query(
+            """select page from tripids join ids on tripids.sid=ids.id
+            where n3='_:g2'"""))
+        self.assertEqual([(SCHEMA_VERSION,)],
+                         self.query("PRAGMA user_version"))
+
+    def test_load_shared_blank_nodes(self):
+        backend = RDFBackend(os.path.join(self.dir, "shared.db"))
+        backend.load(BytesIO((
+            "<%(b)sdata/a> <%(b)sontology#p> _:s .\n"
+            "<%(b)sdata/b> <%(b)sontology#p> _:s .\n"
+            "_:s <%(b)sontology#p> \"shared\" .\n"
+            "_:o <%(b)sontology#p> \"orphan\" .\n"
+            % {'b': BASE_NAME}).encode('utf-8')))
+        self.assertEqual([("<BLANK>", "_:o"), ("data/a", "_:s"),
+                          ("data/b", "_:s")],
+                         backend.connection().execute(
+                             """select page, subject from triples
+                             where subject like '\\_:%' escape '\\'
+                             order by page""").fetchall())
+        self.assertEqual(2, len(backend.lookup("data/b")))
+        _, _, results = backend.sparql_query(
+            "select ?s ?o where { ?s <%sontology#p> ?o } limit 10" %
+            BASE_NAME, "sparql-json", None, 10)
+        bindings = json.loads("".join(results))['results']['bindings']
+        self.assertEqual(["orphan", "shared"],
+                         sorted(b['o']['value'] for b in bindings
+                                if b['o']['type'] == 'literal'))
+        backend.close()
+
+    def test_load_replaces(self):
+        conn = self.backend.connection()
+        generation = self.backend.generation()
+        os.chmod(self.db, 0o644)
+        mode = os.stat(self.db).st_mode
+        self.backend.load(BytesIO(DUMP.replace(
+            "\"Example\"", "\"Changed\"").encode('utf-8')))
+        self.assertEqual(["test.db"], os.listdir(self.dir))
+        self.assertEqual(mode, os.stat(self.db).st_mode)
+        # The old connection still reads the database it opened
+        self.assertEqual(1, conn.execute("""select count(*) from ids
+            where label='Example'""").fetchone()[0])
+        self.assertNotEqual(generation, self.backend.generation())
+        self.assertEqual([("Changed",)], self.query(
+            "select label from ids where n3=?",
+            "<%sdata/example>" % BASE_NAME))
+
+    def test_load_failed(self):
+        def lines():
+            yield DUMP.encode('utf-8')
+            raise IOError("Truncated dump")
+        with self.assertRaises(IOError):
+            self.backend.load(lines())
+        self.assertEqual(["test.db"], os.listdir(self.dir))
+        self.assertEqual(["data/example"], [
+            r['id'] for r in self.backend.search("Example", None, 0)])
+
+    def test_load_batches(self):
+        db = os.path.join(self.dir, "batches.db")
+        backend = RDFBackend(db)
+        backend.load(BytesIO(("# A comment\n\n" + DUMP).encode('utf-8')),
+                     batch_size=3)
+        for table in ["ids", "tripids", "free_text"]:
+            sql = "select * from %s order by rowid" % table
+            self.assertEqual(
+                self.query(sql),
+                backend.connection().execute(sql).fetchall())
+        backend.close()
+
+    def test_load_parallel(self):
+        db = os.path.join(self.dir, "parallel.db")
+        backend = RDFBackend(db)
+        backend.load(BytesIO(DUMP.encode('utf-8')), batch_size=2,
+                     processes=2)
+        for table in ["ids", "tripids", "free_text", "links"]:
+            sql = "select * from %s order by rowid" % table
+            self.assertEqual(
+                self.query(sql),
+                backend.connection().execute(sql).fetchall())
+        backend.close()
+
+    def test_lookup(self):
+        g = self.backend.lookup("data/example")
+        self.assertIsNotNone(g)
+        self.assertIsNone(self.backend.lookup("data/junk"))
+
+    def test_lookup_blanks(self):
+        g = self.backend.lookup("data/example")
+        self.assertIn("A note", [str(o) for o in g.objects()])
+
+    def test_lookup_page_table(self):
+        backend = RDFBackend(os.path.join(self.dir, "pages.db"))
+        backend.load(BytesIO(DUMP.encode('utf-8')), page_table=True)
+        self.assertTrue(backend.pool.has_table("page_triples"))
+        self.assertFalse(self.backend.pool.has_table("page_triples"))
+        for id in ["data/example", "data/other"]:
+            self.assertEqual(sorted(self.backend.lookup_rows(id)),
+                             sorted(backend.lookup_rows(id)))
+        backend.close()
+
+    def test_lookup_version_0(self):
+        expected = len(self.backend.lookup("data/example"))
+        conn = sqlite3.connect(self.db)
+        conn.execute("""update tripids set page='<BLANK>' where sid in
+                        (select id from ids where substr(n3, 1, 2)='_:')""")
+        conn.execute("PRAGMA user_version=0")
+        conn.commit()
+        conn.close()
+        backend = RDFBackend(self.db)
+        self.assertEqual(0, backend.pool.version())
+        self.assertEqual(expected, len(backend.lookup("data/example")))
+        backend.close()
+
+    def test_lookup_blank_cycle(self):
+        backend = RDFBackend(os.path.join(self.dir, "cycle.db"))
+        backend.load(BytesIO((
+            "<%(b)sdata/c> <%(b)sontology#p> _:c1 .\n"
+            "_:c1 <%(b)sontology#p> _:c2 .\n"
+            "_:c1 <%(b)sontology#p> _:c3 .\n"
+            "_:c2 <%(b)sontology#p> _:c1 .\n"
+            "_:c3 <%(b)sontology#p> \"end\" .\n"
+            % {'b': BASE_NAME}).encode('utf-8')))
+        self.assertEqual(5, len(backend.lookup("data/c")))
+        backend.close()
+
+    def test_summarize_many(self):
+        summaries = self.backend.summarize_many(
+            ["data/example", "data/other", "data/junk"])
+        self.assertEqual(1, len(summaries["data/example"]))
+        self.assertEqual(1, len(summaries["data/other"]))
+        self.assertEqual(0, len(summaries["data/junk"]))
+        self.assertEqual(0, len(self.backend.summarize_many(
+            ["data/example"], limit=0)["data/example"]))
+
+    def test_list_resources(self):
+        more, refs = self.backend.list_resources(0, 10)
+        self.assertFalse(more)
+        self.assertEqual(set(["data/example", "data/other"]),
+                         set(r['id'] for r in refs))
+
+    def test_list_resources_after(self):
+        more, refs = self.backend.list_resources(0, 1)
+        self.assertTrue(more)
+        more, refs2 = self.backend.list_resources(0, 1,
+                                                  after=refs[0]['token'])
+        self.assertEqual(self.backend.list_resources(1, 1)[1], refs2)
+        self.assertEqual(["data/example", "data/other"],
+                         [refs[0]['id'], refs2[0]['id']])
+
+    def test_list_values_after(self):
+        prop = "<http://www.w3.org/2000/01/rdf-schema#label>"
+        _, values = self.backend.list_values(0, 1, prop)
+        _, values2 = self.backend.list_values(0, 1, prop,
+                                              after=values[0]['token'])
+        self.assertEqual(self.backend.list_values(1, 1, prop)[1], values2)
+
+    def test_load_stats(self):
+        self.assertEqual(10, self.backend.stat("triples"))
+        self.assertEqual(10, self.backend.triple_count())
+        self.assertEqual(5, self.backend.stat("subjects"))
+        self.assertEqual(7, self.backend.stat("properties"))
+        self.assertEqual([("<%sontology#Thing>" % BASE_NAME, 1)],
+                         self.backend.stat_partitions("class"))
+        self.assertIn(("<http://www.w3.org/2000/01/rdf-schema#label>", 4),
+                      self.backend.stat_partitions("property"))
+        self.assertIsNone(self.backend.stat("junk"))
+
+    def test_load_facet_counts(self):
+        self.assertEqual([("\"Example\"@en", 1), ("\"Other\"@en", 1)],
+                         self.query("""select n3, count from facet_counts
+                                       join ids on facet_counts.oid=ids.id
+                                       order by n3"""))
+
+    def test_list_values_not_facet(self):
+        _, values = self.backend.list_values(
+            0, 10, "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>")
+        self.assertEqual([("<%sontology#Thing>" % BASE_NAME, 1)],
+                         [(v['link'], v['count']) for v in values])
+
+    def test_bad_token(self):
+        with self.assertRaises(ValueError):
+            self.backend.list_resources(0, 1, after="junk")
+        with self.assertRaises(ValueError):
+            self.backend.search("Example", None, 0, after="e30=")
+
+    def test_search(self):
+        results = self.backend.search("Example", None, 0)
+        self.assertEqual(["data/example"], [r['id'] for r in results])
+        self.assertEqual(["Example"], [r['label'] for r in results])
+
+    def test_search_prefix(self):
+        self.assertEqual(["data/example"], [
+            r['id'] for r in self.backend.search("Exam*", None, 0)])
+
+    def test_search_property(self):
+        self.assertEqual(["data/other"], [r['id'] for r in self.backend.search(
+            "Other", "http://www.w3.org/2000/01/rdf-schema#label", 0)])
+        self.assertEqual([], self.backend.search(
+            "Other", "%sontology#note" % BASE_NAME, 0))
+
+    def test_search_punctuation(self):
+        self.assertEqual(["data/example"], [
+            r['id'] for r in self.backend.search("Example-\"(", None, 0)])
+        self.assertEqual([], self.backend.search("", None, 0))
+
+    def test_fts_query(self):
+        self.assertEqual('"a-b" "c""d"*', fts_query('a-b c"d*'))
+        self.assertEqual('"a" OR "b"', fts_query("a OR b"))
+        self.assertEqual('"OR" "a" "NOT"', fts_query("OR a NOT"))
+
+    def test_upgrade(self):
+        conn = sqlite3.connect(self.db)
+        rows = conn.execute(
+            "select sid, pid, object from free_text_rows").fetchall()
+        conn.execute("drop table free_text")
+        conn.execute("drop view free_text_rows")
+        conn.execute("drop table free_text_ids")
+        conn.execute("""create virtual table free_text
+                        using fts4(sid integer, pid integer,
+                                   object TEXT NOT NULL)""")
+        conn.executemany("insert into free_text values (?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+        backend = RDFBackend(self.db)
+        self.assertEqual(["data/example"], [
+            r['id'] for r in backend.search("Example", None, 0)])
+        backend.close()
+        self.assertTrue(backend.upgrade())
+        self.assertFalse(backend.upgrade())
+        backend = RDFBackend(self.db)
+        self.assertTrue(backend.pool.has_table("free_text_ids"))
+        self.assertEqual(["data/example"], [
+            r['id'] for r in backend.search("Exam*", None, 0)])
+        backend.close()
+
+    def test_apply_delta(self):
+        label = "<http://www.w3.org/2000/01/rdf-schema#label>"
+        self.assertEqual((2, 1), self.backend.apply_delta(
+            BytesIO(("<%(b)sdata/other> %(l)s \"Changed\"@en .\n"
+                     "<%(b)sdata/other> <%(b)sontology#see> "
+                     "<http://dbpedia.org/resource/Other> .\n"
+                     "<%(b)sdata/other> %(l)s \"Changed\"@en .\n"
+                     % {'b': BASE_NAME, 'l': label}).encode('utf-8')),
+            BytesIO(("<%(b)sdata/other> %(l)s \"Other\"@en .\n"
+                     "<%(b)sdata/other> %(l)s \"Missing\"@en .\n"
+                     % {'b': BASE_NAME, 'l': label}).encode('utf-8'))))
+        self.assertEqual([("Changed",)], self.query(
+            "select label from ids where n3=?", "<%sdata/other>" % BASE_NAME))
+        self.assertEqual(["data/other"], [
+            r['id'] for r in self.backend.search("Changed", None, 0)])
+        self.assertEqual([], self.backend.search("Other", None, 0))
+        self.assertEqual([(2, "http://dbpedia.org/")],
+                         self.query("select count, target from links"))
+        self.assertEqual(11, self.backend.stat("triples"))
+        self.assertEqual([("\"Changed\"@en", 1), ("\"Example\"@en", 1)],
+                         self.query("""select n3, count from facet_counts
+                                       join ids on facet_counts.oid=ids.id
+                                       order by n3"""))
+
+    def test_apply_delta_blank_nodes(self):
+        self.backend.apply_delta(
+            BytesIO(("<%(b)sdata/other> <%(b)sontology#gloss> _:g2 .\n"
+                     % {'b': BASE_NAME}).encode('utf-8')),
+            BytesIO(("_:g1 <%(b)sontology#note> _:g2 .\n"
+                     % {'b': BASE_NAME}).encode('utf-8')))
+        self.assertEqual([("data/other",)], self.query(
+            """select page from tripids join ids on tripids.sid=ids.id
+            where n3='_:g2'"""))
+        self.assertEqual([("data/example",)], self.query(
+            """select page from tripids join ids on tripids.sid=ids.id
+            where n3='_:g1'"""))
+        self.backend.apply_delta(None, BytesIO((
+            "<%(b)sdata/example#s1> <%(b)sontology#gloss> _:g1 .\n"
+            % {'b': BASE_NAME}).encode('utf-8')))
+        self.assertEqual([("<BLANK>",)], self.query(
+            """select page from tripids join ids on tripids.sid=ids.id
+            where n3='_:g1'"""))
+
+    def test_apply_delta_blank_page(self):
+        conn = sqlite3.connect(self.db)
+        delta = DeltaLoad(conn.cursor())
+        delta.add(("_:g2", "<%sontology#note>" % BASE_NAME, "\"More\""))
+        delta.finish()
+        self.assertIn("data/example", delta.pages)
+        self.assertNotIn("<BLANK>", delta.pages)
+        delta.add(("_:z", "<%sontology#note>" % BASE_NAME, "\"Orphan\""))
+        delta.finish()
+        self.assertIn("<BLANK>", delta.pages)
+        conn.rollback()
+        conn.close()
+
+    def test_apply_delta_same_as_load(self):
+        lines = DUMP.splitlines(True)
+        backend = RDFBackend(os.path.join(self.dir, "delta.db"))
+        backend.load(BytesIO("".join(lines[2:]).encode('utf-8')))
+        backend.apply_delta(BytesIO("".join(lines[:4]).encode('utf-8')))
+        sql = """select s.n3, p.n3, o.n3, page, head, s.label from tripids
+                 join ids as s on sid=s.id join ids as p on pid=p.id
+                 join ids as o on oid=o.id order by 1, 2, 3, 4, 5"""
+        self.assertEqual(self.query(sql),
+                         backend.connection().execute(sql).fetchall())
+        self.assertEqual(self.query("select * from stats order by 1, 2"),
+                         backend.connection().execute(
+                             "select * from stats order by 1, 2").fetchall())
+        backend.close()
+
+    def test_search_after(self):
+        backend = RDFBackend(os.path.join(self.dir, "many.db"))
+        backend.load(BytesIO("".join(
+            "<%sdata/r%d> <%sontology#note> \"common %s\" .\n" %
+            (BASE_NAME, i, BASE_NAME, "word " * i)
+            for i in range(5)).encode('utf-8')))
+        results = backend.search("common", None, 0, 2)
+        self.assertEqual(["data/r0", "data/r1", "data/r2"],
+                         [r['id'] for r in results])
+        self.assertEqual(["data/r2", "data/r3", "data/r4"], [
+            r['id'] for r in backend.search("common", None, 0, 2,
+                                            results[1]['token'])])
+        backend.close()
+
+    def test_search_unlabelled(self):
+        backend = RDFBackend(os.path.join(self.dir, "unlabelled.db"))
+        backend.load(BytesIO((
+            "<%sdata/plain> <%sontology#note> \"unlabelled\" .\n"
+            % (BASE_NAME, BASE_NAME)).encode('utf-8')))
+        self.assertEqual(["Data/plain"], [
+            r['label'] for r in backend.search("unlabelled", None, 0)])
+        backend.close()
+
+    def test_connection_reused(self):
+        self.assertIs(self.backend.connection(), self.backend.connection())
+
+    def test_connection_per_thread(self):
+        conns = []
+        t = threading.Thread(
+            target=lambda: conns.append(self.backend.connection()))
+        t.start()
+        t.join()
+        self.assertIsNot(self.backend.connection(), conns[0])
+        self.assertEqual(2, len(self.backend.pool.connections))
+
+    def test_connection_read_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.backend.connection().execute("delete from tripids")
+
+    def test_connection_mmap(self):
+        self.assertEqual(
+            [(os.path.getsize(self.db),)],
+            self.backend.connection().execute("PRAGMA mmap_size").fetchall())
+
+    def apply_link(self, immutable):
+        """Apply a delta of one link, with SQLITE_IMMUTABLE set as given"""
+        setting = yuzu.backend.SQLITE_IMMUTABLE
+        yuzu.backend.SQLITE_IMMUTABLE = immutable
+        try:
+            self.backend.apply_delta(BytesIO((
+                "<%(b)sdata/new> <%(b)sontology#link> <%(b)sdata/other> .\n"
+                % {'b': BASE_NAME}).encode('utf-8')))
+        finally:
+            yuzu.backend.SQLITE_IMMUTABLE = setting
+
+    def test_apply_delta_copy(self):
+        conn = self.backend.connection()
+        self.apply_link(True)
+        self.assertEqual(["test.db"], os.listdir(self.dir))
+        self.assertEqual(13, conn.execute(
+            "select count(*) from tripids").fetchone()[0])
+        self.assertEqual(15, self.query("select count(*) from tripids")[0][0])
+
+    def test_apply_delta_in_place(self):
+        inode = os.stat(self.db).st_ino
+        self.apply_link(False)
+        self.assertEqual(inode, os.stat(self.db).st_ino)
+        self.assertEqual(15, self.query("select count(*) from tripids")[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+if sys.version_info[0] < 3:
+    from urllib import quote_plus, urlencode
+else:
+    from urllib.parse import quote_plus, urlencode
+
+from rdflib import URIRef
+
+import yuzu.server
+from yuzu.backend import RDFBackend, encode_token
+from yuzu.benchmark import synthetic_dump, wsgi_get
+from yuzu.cache import LRUCache, TERMS, from_n3, memoize
+from yuzu.server import RDFServer, TemplateRegistry, encode_chunks
+from yuzu.test_backend import DUMP
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, "test.db")
+        RDFBackend(self.db).load(BytesIO(DUMP.encode('utf-8')))
+        self.srv = RDFServer(self.db)
+
+    def tearDown(self):
+        self.srv.backend.close()
+        shutil.rmtree(self.dir)
+
+    def test_page(self):
+        status, body = wsgi_get(self.srv, "/data/example")
+        self.assertEqual("200 OK", status)
+        self.assertIn(b"Example", body)
+
+    def test_page_cached(self):
+        _, body = wsgi_get(self.srv, "/data/example")
+        _, body2 = wsgi_get(self.srv, "/data/example")
+        self.assertEqual(body, body2)
+        self.assertEqual(1, self.srv.cache.pages.hits)
+
+    def test_not_modified(self):
+        headers = []
+        srv = self.srv
+        environ = {'PATH_INFO': '/data/example', 'HTTP_ACCEPT': 'text/html'}
+        setup_testing_defaults(environ)
+        srv.application(environ, lambda s, h: headers.extend(h))
+        etag = dict(headers)['ETag']
+        status = []
+        environ['HTTP_IF_NONE_MATCH'] = 'W/"other", ' + etag
+        body = srv.application(environ, lambda s, h: status.append(s))
+        self.assertEqual(['304 Not Modified'], status)
+        self.assertEqual([], body)
+
+    def test_not_modified_any(self):
+        for path, expected in [("/data/junk", "404 Not Found"),
+                               ("/data/example", "304 Not Modified"),
+                               ("/data/example", "304 Not Modified"),
+                               ("/about", "304 Not Modified")]:
+            status = []
+            environ = {'PATH_INFO': path, 'HTTP_ACCEPT': 'text/html',
+                       'HTTP_IF_NONE_MATCH': '*'}
+            setup_testing_defaults(environ)
+            self.srv.application(environ, lambda s, h: status.append(s))
+            self.assertEqual([expected], status, path)
+
+    def test_cache_invalidated_on_reload(self):
+        wsgi_get(self.srv, "/data/example")
+        db2 = os.path.join(self.dir, "test2.db")
+        RDFBackend(db2).load(BytesIO(DUMP.replace(
+            "\"Example\"", "\"Changed\"").encode('utf-8')))
+        os.rename(db2, self.db)
+        _, body = wsgi_get(self.srv, "/data/example")
+        self.assertIn(b"Changed", body)
+
+    def test_reload_in_place(self):
+        wsgi_get(self.srv, "/list/")
+        RDFBackend(self.db).load(BytesIO(DUMP.replace(
+            "data/other", "data/more").encode('utf-8')))
+        _, body = wsgi_get(self.srv, "/list/")
+        self.assertIn(b"/data/more", body)
+        self.assertNotIn(b"/data/other", body)
+
+    def test_metadata(self):
+        for path in ["/about", "/about.ttl", "/about.nt", "/about.rdf"]:
+            status, body = wsgi_get(self.srv, path)
+            self.assertEqual("200 OK", status)
+            self.assertIn(b"void", body)
+
+    def test_metadata_cached(self):
+        _, body = wsgi_get(self.srv, "/about.ttl")
+        _, body2 = wsgi_get(self.srv, "/about.ttl")
+        self.assertEqual(body, body2)
+        self.assertEqual(1, self.srv.metadata.pages.hits)
+        db2 = os.path.join(self.dir, "test2.db")
+        RDFBackend(db2).load(BytesIO((DUMP + DUMP.replace(
+            "data/other", "data/more")).encode('utf-8')))
+        os.rename(db2, self.db)
+        _, body3 = wsgi_get(self.srv, "/about.ttl")
+        self.assertNotEqual(body, body3)
+
+    def test_metadata_triples(self):
+        triples = re.compile(b"about> <http://rdfs.org/ns/void#triples> "
+                             b"\"(\\d+)\"")
+        _, body = wsgi_get(self.srv, "/about.nt")
+        self.assertEqual(b"10", triples.search(body).group(1))
+        RDFBackend(self.db).load(BytesIO((DUMP + DUMP.replace(
+            "data/other", "data/more")).encode('utf-8')))
+        _, body = wsgi_get(self.srv, "/about.nt")
+        self.assertEqual(b"13", triples.search(body).group(1))
+
+    def test_not_found(self):
+        status, _ = wsgi_get(self.srv, "/data/junk")
+        self.assertEqual("404 Not Found", status)
+
+    def test_list(self):
+        status, body = wsgi_get(self.srv, "/list/")
+        self.assertEqual("200 OK", status)
+        self.assertIn(b"/data/other", body)
+
+    def test_list_next(self):
+        db = os.path.join(self.dir, "list.db")
+        RDFBackend(db).load(synthetic_dump(25))
+        srv = RDFServer(db)
+        _, body = wsgi_get(srv, "/list/")
+        after = re.search(b"offset=20&amp;after=([^&']*)", body).group(1)
+        _, body2 = wsgi_get(srv, "/list/",
+                            "offset=20&after=" + after.decode('ascii'))
+        _, body3 = wsgi_get(srv, "/list/", "offset=20")
+        self.assertEqual(body3, body2)
+        self.assertIn(b"21 - 25", body2)
+        srv.backend.close()
+
+    def test_bad_token(self):
+        status, _ = wsgi_get(self.srv, "/list/", "after=junk")
+        self.assertEqual("400 Bad Request", status)
+        label = "prop=" + quote_plus("http://www.w3.org/2000/01/rdf-schema#"
+                                     "label")
+        for path, qs in [
+                ("/list/", "after=" + encode_token([])),
+                ("/list/", "after=" + encode_token([{"a": 1}])),
+                ("/list/", label + "&obj_after=" + encode_token([[1], 2])),
+                ("/list/", label + "&obj_after=" + encode_token([1])),
+                ("/search", "query=Example&after=" + encode_token([])),
+                ("/search", "query=Example&after=" + encode_token([[1]])),
+                ("/search", "query=Example&after=" + encode_token([True]))]:
+            status, _ = wsgi_get(self.srv, path, qs)
+            self.assertEqual("400 Bad Request", status, path + "?" + qs)
+
+    def test_search(self):
+        status, body = wsgi_get(self.srv, "/search", "query=Example")
+        self.assertEqual("200 OK", status)
+        self.assertIn(b"/data/example", body)
+
+    def sparql(self, accept):
+        return wsgi_get(self.srv, "/sparql", urlencode({
+            'query': 'select * where { ?s rdfs:label ?o } limit 10'}),
+            accept)
+
+    def test_sparql_json(self):
+        status, body = self.sparql("application/sparql-results+json")
+        self.assertEqual("200 OK", status)
+        results = json.loads(body.decode('utf-8'))
+        self.assertEqual(["s", "o"], results['head']['vars'])
+        self.assertEqual(4, len(results['results']['bindings']))
+        self.assertIn({'type': 'literal', 'xml:lang': 'en',
+                       'value': 'Example'},
+                      [b['o'] for b in results['results']['bindings']])
+
+    def test_sparql_xml(self):
+        status, body = self.sparql("application/sparql-results+xml")
+        self.assertEqual("200 OK", status)
+        self.assertEqual(4, body.count(b"<result>"))
+
+    def test_sparql_streamed(self):
+        environ = {'PATH_INFO': '/sparql', 'QUERY_STRING': urlencode({
+            'query': 'select * where { ?s rdfs:label ?o } limit 10'}),
+            'HTTP_ACCEPT': 'application/sparql-results+xml'}
+        setup_testing_defaults(environ)
+        body = self.srv.application(environ, lambda s, h: None)
+        self.assertNotIsInstance(body, list)
+        self.assertTrue(next(iter(body)).startswith(b"<?xml"))
+        body.close()
+
+
+class EncodeChunksTest(unittest.TestCase):
+
+    def test_string(self):
+        self.assertEqual([u"caf\u00e9".encode('utf-8')],
+                         list(encode_chunks(u"caf\u00e9")))
+
+    def test_grouped(self):
+        self.assertEqual([b"aaabbb", b"cc"],
+                         list(encode_chunks(["aaa", "bbb", "cc"], size=4)))
+
+
+class TemplateRegistryTest(unittest.TestCase):
+
+    def test_parsed_once(self):
+        templates = TemplateRegistry()
+        self.assertIs(templates.parse(templates.source("page.mustache")),
+                      templates.parse(templates.source("page.mustache")))
+
+    def test_no_reload(self):
+        templates = TemplateRegistry(reload=False)
+        templates.sources["page.mustache"] = (0, "stale")
+        self.assertEqual("stale", templates.source("page.mustache"))
+
+    def test_reload(self):
+        templates = TemplateRegistry(reload=True)
+        templates.sources["page.mustache"] = (0, "stale")
+        self.assertNotEqual("stale", templates.source("page.mustache"))
+
+    def test_partials(self):
+        templates = TemplateRegistry()
+        html = templates.render("rdf2html.mustache", {
+            'head': {'display': 'Head', 'triples': [{
+                'prop': {'display': 'Prop', 'uri': 'http://www.example.com/p'},
+                'obj': [{'elem': {'display': 'Value', 'literal': True},
+                         'last': True}]}]},
+            'tail': []})
+        self.assertIn("Value", html)
+
+    def test_uncached_partials(self):
+        templates = TemplateRegistry()
+        context = {'head': {'display': 'Head', 'triples': [{
+            'prop': {'display': 'Prop', 'uri': 'http://www.example.com/p'},
+            'obj': [{'elem': {'display': 'Value', 'literal': True},
+                     'last': True}]}]}, 'tail': []}
+        html = templates.render("rdf2html.mustache", context)
+        cached = yuzu.server.CACHED_PARTIALS
+        yuzu.server.CACHED_PARTIALS = False
+        try:
+            self.assertEqual(html, templates.render("rdf2html.mustache",
+                                                    context))
+        finally:
+            yuzu.server.CACHED_PARTIALS = cached
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evict(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+
+    def test_size(self):
+        cache = LRUCache(10, sizeof=lambda k, v: len(v))
+        cache.put("a", b"12345")
+        cache.put("b", b"123456")
+        self.assertEqual(["b"], list(cache.values))
+        cache.put("c", b"12345678901")
+        self.assertNotIn("c", cache)
+
+    def test_terms(self):
+        n3 = "<http://www.example.com/term-cache-test>"
+        hits = TERMS.hits
+        term = from_n3(n3)
+        self.assertEqual(URIRef("http://www.example.com/term-cache-test"),
+                         term)
+        self.assertIs(term, from_n3(n3))
+        self.assertEqual(hits + 1, TERMS.hits)
+
+    def test_memoize(self):
+        calls = []
+
+        @memoize(10)
+        def double(x):
+            calls.append(x)
+            return 2 * x
+        self.assertEqual([4, 4, 6], [double(2), double(2), double(3)])
+        self.assertEqual([2, 3], calls)
+
+
+class ApplicationTest(unittest.TestCase):
+
+    def tearDown(self):
+        yuzu.server._server = None
+        yuzu.server._server_pid = None
+
+    def test_server_reused(self):
+        self.assertIs(yuzu.server.get_server(), yuzu.server.get_server())
+
+    def test_server_recreated_after_fork(self):
+        srv = yuzu.server.get_server()
+        yuzu.server._server_pid = -1
+        self.assertIsNot(srv, yuzu.server.get_server())
+        self.assertEqual(os.getpid(), yuzu.server._server_pid)
+
+
+if __name__ == '__main__':
+    unittest.main()